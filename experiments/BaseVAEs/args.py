@@ -17,6 +17,8 @@ def _get_parser():
     # parser.add_argument('--learn', type=str, required=True, help='unsup, weakly or sup')
 
     parser.add_argument('--save-step', type=int, default=50, help='save model every # steps')
+    parser.add_argument('--keep-ckpts', type=int, default=None,
+                        help='number of most recent checkpoints to keep, older ones are deleted. Keeps all by default')
     parser.add_argument('--print-step', type=int, default=10, help='print metrics every # steps')
     parser.add_argument('--display-step', type=int, default=1,
                         help='track metrics and iamges on tensorboard every # steps')
@@ -37,6 +39,10 @@ def _get_parser():
                                                                            'have 2xbs')
     parser.add_argument('-e', '--epochs', type=int, default=500, help='batch size')
     parser.add_argument('--n-workers', type=int, default=2, help='workers to load data')
+    parser.add_argument('--data-storage', type=str, default='memory', choices=['memory', 'uint8', 'mmap'],
+                        help="how the image pairs are stored, 'memory': normalized float arrays, 'uint8': uint8 "
+                             "[N, 2, C, W, H] arrays cached beside the data files, scaled to float per batch, "
+                             "'mmap': memory mapped raw arrays, normalized per batch")
     # TODO: sofar only support groups with same number of classes
     parser.add_argument('-pv', '--prototype-vectors', type=int , nargs='+', default=[2, 2],
                         help='List of img shape dims [#p1, #p2, ...]')
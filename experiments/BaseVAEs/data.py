@@ -1,9 +1,13 @@
 import os
+import json
+import struct
+import zipfile
 import torch
 import pickle
 from torchvision import transforms
 import numpy as np
 from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
 
 
 def get_dataloader(config):
@@ -11,24 +15,25 @@ def get_dataloader(config):
     dataset = load_data(config)
     print(f" Config num_workers: {config['n_workers']}")
     return torch.utils.data.DataLoader(dataset, batch_size=config['batch_size'],
-                                       shuffle=True, num_workers=config['n_workers'], pin_memory=True)
+                                       shuffle=True, num_workers=config['n_workers'], pin_memory=True,
+                                       collate_fn=getattr(dataset, 'collate_fn', None))
 
 def load_data(config):
     print('Loading data...')
     print('Dataset: {}'.format(config['dataset']))
     # dataloader setup
     if config['dataset'] == 'ecr':
-        dataset = ECR_PairswithTest(config['data_dir'], attrs='')
+        dataset = ECR_PairswithTest(config['data_dir'], attrs='', storage=config.get('data_storage', 'memory'))
         config['img_shape'] = (3, 64, 64)
         return dataset
     elif config['dataset'] == 'ecr_spot':
         dataset = ECR_PairswithTest(config['data_dir'],
-                                            attrs='_spot')
+                                            attrs='_spot', storage=config.get('data_storage', 'memory'))
         config['img_shape'] = (3, 64, 64)
         return dataset
     elif config['dataset'] == 'ecr_nospot':
         dataset = ECR_PairswithTest(config['data_dir'],
-                                            attrs='_nospot')
+                                            attrs='_nospot', storage=config.get('data_storage', 'memory'))
         config['img_shape'] = (3, 64, 64)
         return dataset
     elif config['dataset'] == 'dsprites':
@@ -60,18 +65,183 @@ def get_test_set(data_loader, config):
     print('y_set shape: {}'.format(np.shape(y_set)))
     print('\ty_set: {}'.format(y_set))
     for u in y_set:
-        x_set.append(np.moveaxis(x[y.index(u)][0], (0, 1, 2), (1, 2, 0)))
-    x_set = torch.Tensor(x_set)
+        if getattr(data_loader.dataset, 'storage', 'memory') == 'uint8':
+            # already stored as [2, C, W, H]
+            x_set.append(x[y.index(u)][0].float() / 255.)
+        elif getattr(data_loader.dataset, 'storage', 'memory') == 'mmap':
+            # raw values of the memory map, normalize with the test set statistics
+            x_set.append(normalize_to_float(torch.from_numpy(np.moveaxis(x[y.index(u)][0], 2, 0).copy()),
+                                            *data_loader.dataset.test_minmax))
+        else:
+            x_set.append(torch.Tensor(np.moveaxis(x[y.index(u)][0], (0, 1, 2), (1, 2, 0))))
+    x_set = torch.stack(x_set)
     x_set = x_set.to(config['device'])
 
     y_set = torch.tensor(y_set)
     return x_set, y_set
 
 
+def get_uint8_cache_path(data_path):
+    return data_path.replace('.npy', '_uint8.npy')
+
+
+def get_minmax_path(data_path):
+    return data_path.replace('.npy', '_minmax.json')
+
+
+def compute_minmax(data_path, chunk_size=1000):
+    """
+    Computes the global min and max of a .npy array in one chunked pass over a read only memory map of the file, i.e.
+    without loading the whole array. The result is cached in a small json sidecar file beside the source file and
+    recomputed if the source file is newer than the sidecar.
+    :param data_path: path to the .npy file
+    :param chunk_size: number of entries (along the first axis) processed at once
+    :return: (min, max)
+    """
+    minmax_path = get_minmax_path(data_path)
+    if os.path.exists(minmax_path) and os.path.getmtime(minmax_path) >= os.path.getmtime(data_path):
+        with open(minmax_path, 'r') as f:
+            minmax = json.load(f)
+        return minmax['min'], minmax['max']
+
+    data = np.load(data_path, mmap_mode='r')
+    data_min, data_max = None, None
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start:start + chunk_size]
+        data_min = chunk.min() if data_min is None else min(data_min, chunk.min())
+        data_max = chunk.max() if data_max is None else max(data_max, chunk.max())
+    data_min, data_max = data_min.item(), data_max.item()
+
+    with open(minmax_path, 'w') as f:
+        json.dump({'min': data_min, 'max': data_max}, f)
+
+    return data_min, data_max
+
+
+def convert_pairs_to_uint8(data_path, chunk_size=1000):
+    """
+    Converts an array of image pairs [N, 2, W, H, C] into a contiguous uint8 array of shape [N, 2, C, W, H], which
+    is cached beside the source file and rebuilt if the source file is newer than the cache. The images are min max
+    normalized over the whole array and quantized exactly as in ECR_PairswithTest.__getitem__, but chunk wise, so that
+    no full size float copy of the data is created.
+    :param data_path: path to the *_pairs.npy file
+    :param chunk_size: number of pairs converted at once
+    :return: path to the cached uint8 array
+    """
+    cache_path = get_uint8_cache_path(data_path)
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(data_path):
+        return cache_path
+
+    print(f"Converting {data_path} to uint8 cache {cache_path}")
+    data = np.load(data_path, mmap_mode='r')
+    data_min, data_max = compute_minmax(data_path, chunk_size)
+
+    n_samples, n_imgs, width, height, n_channels = data.shape
+    # write to a temporary file first so that an interrupted conversion never leaves a partial cache behind
+    tmp_path = cache_path + '.tmp'
+    cache = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                      shape=(n_samples, n_imgs, n_channels, width, height))
+    for start in range(0, n_samples, chunk_size):
+        chunk = (data[start:start + chunk_size] - data_min) / (data_max - data_min)
+        cache[start:start + chunk_size] = np.moveaxis(np.uint8(chunk * 255), 4, 2)
+    cache.flush()
+    del cache
+    os.replace(tmp_path, cache_path)
+
+    return cache_path
+
+
+def normalize_to_float(imgs, data_min, data_max):
+    """
+    Min max normalizes raw images (or a list/tuple thereof) and quantizes them to 1/255 steps, with the same float64
+    arithmetic as np.uint8(x * 255) followed by ToTensor in the 'memory' mode of ECR_PairswithTest.
+    """
+    if isinstance(imgs, (list, tuple)):
+        return type(imgs)(normalize_to_float(img, data_min, data_max) for img in imgs)
+    imgs = (imgs.double() - data_min) / (data_max - data_min)
+    return torch.floor(imgs * 255).float().div_(255.)
+
+
+def uint8_to_float(imgs):
+    """
+    Scales uint8 images (or a list/tuple thereof) to float images in [0, 1].
+    """
+    if isinstance(imgs, (list, tuple)):
+        return type(imgs)(uint8_to_float(img) for img in imgs)
+    return imgs.float().div_(255.)
+
+
+LABEL_SCHEMA_KEY = '__schema__'
+
+
+def get_label_sidecar_path(labels_path):
+    return labels_path.replace('.pkl', '.npz')
+
+
+def read_label_columns(path):
+    """
+    Reads a columnar label file as written by icsn.data.convert_labels. The file is an uncompressed npz, so every column is
+    stored as a raw .npy member and is memory mapped (copy on write) instead of read, i.e. opening the file takes
+    constant time and the pages are shared between all processes reading it.
+    :param path: path to the npz file
+    :return: (schema dict, dict of column name to array)
+    """
+    schema = None
+    columns = {}
+    with zipfile.ZipFile(path) as zf, open(path, 'rb') as f:
+        for info in zf.infolist():
+            name = info.filename[:-len('.npy')]
+            if name == LABEL_SCHEMA_KEY:
+                with zf.open(info) as member:
+                    schema = json.loads(str(np.lib.format.read_array(member, allow_pickle=False)))
+                continue
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f'{path} is compressed and cannot be memory mapped, please reconvert it')
+
+            # skip the local file header, i.e. its 30 fixed bytes plus the file name and extra field
+            f.seek(info.header_offset)
+            name_len, extra_len = struct.unpack('<HH', f.read(30)[26:30])
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            columns[name] = np.memmap(path, dtype=dtype, mode='c', shape=shape, offset=f.tell(),
+                                      order='F' if fortran_order else 'C')
+    return schema, columns
+
+
+def load_labels(labels_path):
+    """
+    Loads a label dict, from the columnar npz sidecar of the pickle file if one exists and is not older than the pickle
+    file, otherwise from the pickle file itself.
+    """
+    sidecar_path = get_label_sidecar_path(labels_path)
+    if os.path.exists(sidecar_path):
+        if not os.path.exists(labels_path) or os.path.getmtime(sidecar_path) >= os.path.getmtime(labels_path):
+            print(f"Loading {sidecar_path}")
+            return read_label_columns(sidecar_path)[1]
+        print(f"{sidecar_path} is older than {labels_path}, please reconvert it")
+
+    print(f"Loading {labels_path}")
+    with open(labels_path, 'rb') as f:
+        return pickle.load(f)
+
+
 class ECR_PairswithTest(Dataset):
-    def __init__(self, root, attrs, mode='train', single=False):
+    def __init__(self, root, attrs, mode='train', single=False, storage='memory'):
+        """
+        :param storage: 'memory' keeps the normalized float arrays in memory and converts each image via PIL,
+        'uint8' loads (and if required creates) a uint8 [N, 2, C, W, H] cache of the arrays and returns zero copy
+        uint8 slices, which are only scaled to float in collate_fn, i.e. once per batch. 'mmap' opens the arrays as
+        read only memory maps and returns the raw values, which are min max normalized in collate_fn with the global
+        statistics from compute_minmax.
+        """
+        assert storage in ['memory', 'uint8', 'mmap'], f'Unknown storage {storage}'
         self.root = os.path.join(root,'ECR')
         self.single_imgs = single
+        self.storage = storage
         print("root path: {}".format(self.root))
         # print as absolute path
         print("root path: {}".format(os.path.abspath(self.root)))
@@ -84,23 +254,31 @@ class ECR_PairswithTest(Dataset):
         self.train_labels_path = os.path.sep.join([self.root, mode, f"{mode}_ecr{attrs}_labels_pairs.pkl"])
         self.test_labels_path = os.path.sep.join([self.root, "test", f"test_ecr{attrs}_labels_pairs.pkl"])
 
-        self.train_data = np.load(self.train_data_path, allow_pickle=True)
-        self.test_data = np.load(self.test_data_path, allow_pickle=True)
+        if self.storage == 'uint8':
+            self.train_data = torch.from_numpy(np.load(convert_pairs_to_uint8(self.train_data_path)))
+            self.test_data = torch.from_numpy(np.load(convert_pairs_to_uint8(self.test_data_path)))
+        elif self.storage == 'mmap':
+            self.train_minmax = compute_minmax(self.train_data_path)
+            self.test_minmax = compute_minmax(self.test_data_path)
+            self._open_mmaps()
+        else:
+            self.train_data = np.load(self.train_data_path, allow_pickle=True)
+            self.test_data = np.load(self.test_data_path, allow_pickle=True)
 
-        self.train_data = (self.train_data - self.train_data.min()) / (self.train_data.max() - self.train_data.min())
-        self.test_data = (self.test_data - self.test_data.min()) / (self.test_data.max() - self.test_data.min())
+            self.train_data = (self.train_data - self.train_data.min()) / (self.train_data.max() - self.train_data.min())
+            self.test_data = (self.test_data - self.test_data.min()) / (self.test_data.max() - self.test_data.min())
+
+        self.transform = transforms.Compose([
+            transforms.ToPILImage(),
+            transforms.ToTensor(),
+        ])
 
-        with open(self.train_labels_path, 'rb') as f:
-            labels_dict = pickle.load(f)
-            self.train_labels = labels_dict['labels_one_hot']
-            self.train_labels_as_id = labels_dict['labels']
-            try:
-                self.shared_labels = labels_dict['shared_labels']
-            except:
-                self.shared_labels = None
-        with open(self.test_labels_path, 'rb') as f:
-            labels_dict = pickle.load(f)
-            self.test_labels = labels_dict['labels_one_hot']
+        labels_dict = load_labels(self.train_labels_path)
+        self.train_labels = labels_dict['labels_one_hot']
+        self.train_labels_as_id = labels_dict['labels']
+        self.shared_labels = labels_dict.get('shared_labels', None)
+        labels_dict = load_labels(self.test_labels_path)
+        self.test_labels = labels_dict['labels_one_hot']
 
     def __getitem__(self, index):
         imgs = self.train_data[index]
@@ -114,14 +292,18 @@ class ECR_PairswithTest(Dataset):
         else:
             shared_labels = (labels_ids[0] == labels_ids[1])
 
-        transform = transforms.Compose([
-            transforms.ToPILImage(),
-            transforms.ToTensor(),
-        ])
-
-        # transform the positive negative samples
-        img0 = transform(np.uint8(imgs[0]*255)).float()
-        img1 = transform(np.uint8(imgs[1]*255)).float()
+        if self.storage == 'uint8':
+            # zero copy views, scaled to float in collate_fn
+            img0 = imgs[0]
+            img1 = imgs[1]
+        elif self.storage == 'mmap':
+            # raw values as [C, W, H], normalized in collate_fn
+            img0 = torch.from_numpy(np.moveaxis(imgs[0], 2, 0).copy())
+            img1 = torch.from_numpy(np.moveaxis(imgs[1], 2, 0).copy())
+        else:
+            # transform the positive negative samples
+            img0 = self.transform(np.uint8(imgs[0]*255)).float()
+            img1 = self.transform(np.uint8(imgs[1]*255)).float()
         # img_size = tuple(img0.shape[-2:])
 
         if self.single_imgs:
@@ -132,6 +314,31 @@ class ECR_PairswithTest(Dataset):
 
     def __len__(self):
         return len(self.train_data)
+
+    def collate_fn(self, batch):
+        batch = default_collate(batch)
+        if self.storage == 'uint8':
+            batch[0] = uint8_to_float(batch[0])
+        elif self.storage == 'mmap':
+            batch[0] = normalize_to_float(batch[0], *self.train_minmax)
+        return batch
+
+    def _open_mmaps(self):
+        self.train_data = np.load(self.train_data_path, mmap_mode='r')
+        self.test_data = np.load(self.test_data_path, mmap_mode='r')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # memory maps would be pickled with their full content, e.g. for spawned workers, reopen them instead
+        if self.storage == 'mmap':
+            del state['train_data']
+            del state['test_data']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.storage == 'mmap':
+            self._open_mmaps()
     
 class DSpritesDataset(Dataset):
     def __init__(self, root, attrs='', mode='train', single=False):
@@ -150,17 +357,12 @@ class DSpritesDataset(Dataset):
         self.train_data = (self.train_data - self.train_data.min()) / (self.train_data.max() - self.train_data.min())
         self.test_data = (self.test_data - self.test_data.min()) / (self.test_data.max() - self.test_data.min())
 
-        with open(self.train_labels_path, 'rb') as f:
-            labels_dict = pickle.load(f)
-            self.train_labels = labels_dict['labels_one_hot']
-            self.train_labels_as_id = labels_dict['labels']
-            try:
-                self.shared_labels = labels_dict['shared_labels']
-            except:
-                self.shared_labels = None
-        with open(self.test_labels_path, 'rb') as f:
-            labels_dict = pickle.load(f)
-            self.test_labels = labels_dict['labels_one_hot']
+        labels_dict = load_labels(self.train_labels_path)
+        self.train_labels = labels_dict['labels_one_hot']
+        self.train_labels_as_id = labels_dict['labels']
+        self.shared_labels = labels_dict.get('shared_labels', None)
+        labels_dict = load_labels(self.test_labels_path)
+        self.test_labels = labels_dict['labels_one_hot']
 
     def __getitem__(self, index):
         imgs = self.train_data[index]
@@ -210,17 +412,12 @@ class clevrShapeDataset(Dataset):
         self.train_data = (self.train_data - self.train_data.min()) / (self.train_data.max() - self.train_data.min())
         self.test_data = (self.test_data - self.test_data.min()) / (self.test_data.max() - self.test_data.min())
         
-        with open(self.train_labels_path, 'rb') as f:
-            labels_dict = pickle.load(f)
-            self.train_labels = labels_dict['labels_one_hot']
-            self.train_labels_as_id = labels_dict['labels']
-            try:
-                self.shared_labels = labels_dict['shared_labels']
-            except:
-                self.shared_labels = None
-        with open(self.test_labels_path, 'rb') as f:
-            labels_dict = pickle.load(f)
-            self.test_labels = labels_dict['labels_one_hot']
+        labels_dict = load_labels(self.train_labels_path)
+        self.train_labels = labels_dict['labels_one_hot']
+        self.train_labels_as_id = labels_dict['labels']
+        self.shared_labels = labels_dict.get('shared_labels', None)
+        labels_dict = load_labels(self.test_labels_path)
+        self.test_labels = labels_dict['labels_one_hot']
             
     def __getitem__(self, index):
         imgs = self.train_data[index]
@@ -271,17 +468,12 @@ class clevrNoShapeDataset(Dataset):
         self.train_data = (self.train_data - self.train_data.min()) / (self.train_data.max() - self.train_data.min())
         self.test_data = (self.test_data - self.test_data.min()) / (self.test_data.max() - self.test_data.min())
         
-        with open(self.train_labels_path, 'rb') as f:
-            labels_dict = pickle.load(f)
-            self.train_labels = labels_dict['labels_one_hot']
-            self.train_labels_as_id = labels_dict['labels']
-            try:
-                self.shared_labels = labels_dict['shared_labels']
-            except:
-                self.shared_labels = None
-        with open(self.test_labels_path, 'rb') as f:
-            labels_dict = pickle.load(f)
-            self.test_labels = labels_dict['labels_one_hot']
+        labels_dict = load_labels(self.train_labels_path)
+        self.train_labels = labels_dict['labels_one_hot']
+        self.train_labels_as_id = labels_dict['labels']
+        self.shared_labels = labels_dict.get('shared_labels', None)
+        labels_dict = load_labels(self.test_labels_path)
+        self.test_labels = labels_dict['labels_one_hot']
             
     def __getitem__(self, index):
         imgs = self.train_data[index]
@@ -0,0 +1,229 @@
+import argparse
+import glob
+import json
+import os
+import sys
+from concurrent.futures import as_completed
+
+import torch
+from torch.optim import Adam
+
+sys.path.append("experiments/")
+sys.path.append("experiments/BaseVAEs/models/")
+
+from BaseVAEs.models.disent.model.ae import EncoderConv64, DecoderConv64, AutoEncoder
+from BaseVAEs.models.disent.frameworks.vae.unsupervised import BetaVae
+from BaseVAEs.models.disent.frameworks.vae.weaklysupervised import AdaVae, AdaCatVae
+from BaseVAEs.models.disent.data.groundtruth import Cars3dData, DSpritesData, Mpi3dData, SmallNorbData, \
+    Shapes3dData, XYBlocksData, XYObjectData, XYSquaresData
+from BaseVAEs.models.disent.dataset.groundtruth import GroundTruthDataset
+from BaseVAEs.models.disent.metrics import DEFAULT_METRICS, FAST_METRICS, EvaluationSession
+from BaseVAEs.models.disent.transform import ToStandardisedTensor
+from BaseVAEs.models.disent.util import file_hash, seed, spawn_process_pool
+
+
+GT_DATA = {
+    'xysquares': XYSquaresData,
+    'xyobject': XYObjectData,
+    'xyblocks': XYBlocksData,
+    'dsprites': DSpritesData,
+    'shapes3d': Shapes3dData,
+    'cars3d': Cars3dData,
+    'mpi3d': Mpi3dData,
+    'smallnorb': SmallNorbData,
+}
+
+# ground truth dataset of a worker process, built once by _init_worker instead of once per checkpoint
+_WORKER_DATASET = None
+
+
+def make_model(framework, config):
+    """
+    Builds the model of the given framework with the same settings as the corresponding train_disent_*.py script.
+    """
+    if framework == 'betavae':
+        return BetaVae(make_optimizer_fn=lambda params: Adam(params, lr=1e-3),
+                       make_model_fn=lambda: AutoEncoder(
+                           encoder=EncoderConv64(x_shape=(3, 64, 64), z_size=config['n_groups'], z_multiplier=2),
+                           decoder=DecoderConv64(x_shape=(3, 64, 64), z_size=config['n_groups']),
+                       ),
+                       cfg=BetaVae.cfg(beta=4))
+    elif framework in ['adavae', 'adavae_orig']:
+        return AdaVae(make_optimizer_fn=lambda params: Adam(params, lr=1e-3),
+                      make_model_fn=lambda: AutoEncoder(
+                          encoder=EncoderConv64(x_shape=(3, 64, 64), z_size=config['n_groups'], z_multiplier=2),
+                          decoder=DecoderConv64(x_shape=(3, 64, 64), z_size=config['n_groups']),
+                      ),
+                      cfg=AdaVae.cfg(beta=config['beta'], average_mode='gvae', symmetric_kl=False))
+    elif framework == 'adacatvae':
+        z_size = config['n_protos'] * config['n_groups']
+        return AdaCatVae(make_optimizer_fn=lambda params: Adam(params, lr=1e-3),
+                         make_model_fn=lambda: AutoEncoder(
+                             encoder=EncoderConv64(x_shape=(3, 64, 64), z_size=z_size),
+                             decoder=DecoderConv64(x_shape=(3, 64, 64), z_size=z_size),
+                         ),
+                         cfg=AdaCatVae.cfg(beta=4, n_categories=config['n_protos'],
+                                           n_variables=config['n_groups'],
+                                           temp=config['temperature'], eps=1e-12, z_size=z_size,
+                                           average_mode='gvae', symmetric_kl=False))
+    raise ValueError(f'Unknown framework: {framework}')
+
+
+def make_dataset(args):
+    return GroundTruthDataset(GT_DATA[args['gt_data']](), transform=ToStandardisedTensor())
+
+
+def find_checkpoints(run_dir):
+    """
+    Returns the sorted checkpoint files of a run, run_dir is either the results directory of a run or its model
+    directory.
+    """
+    model_dir = os.path.join(run_dir, 'states')
+    if not os.path.isdir(model_dir):
+        model_dir = run_dir
+    return sorted(glob.glob(os.path.join(model_dir, '[0-9]' * 5 + '.pth')))
+
+
+def result_key(ckpt_hash, metric_name, args):
+    """
+    Results are keyed by the content of the checkpoint and the settings of the evaluation, so that renamed or
+    copied checkpoints are not evaluated again.
+    """
+    return ckpt_hash, args['gt_data'], metric_name, args['fast'], args['seed'], args['num_points']
+
+
+def load_results(results_path):
+    """
+    Reads the keys of all the results in the append only results table, a file with one json row per checkpoint and
+    metric.
+    """
+    keys = set()
+    if os.path.exists(results_path):
+        with open(results_path, 'r') as f:
+            for line in f:
+                # a partially written last line of an interrupted run is evaluated again
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                # older rows did not record num_points, they only count as done for the default of None
+                keys.add((row['checkpoint_hash'], row['gt_data'], row['metric'], row['fast'], row['seed'], row.get('num_points')))
+    return keys
+
+
+def _init_worker(args):
+    global _WORKER_DATASET
+    torch.set_num_threads(1)
+    _WORKER_DATASET = make_dataset(args)
+
+
+def evaluate_checkpoint(task):
+    """
+    Evaluates the missing metrics of one checkpoint, all of its metrics are computed from a single encoding of the
+    ground truth data. Returns the rows for the results table.
+    """
+    ckpt_path, ckpt_hash, metric_names, args = task
+    dataset = _WORKER_DATASET if (_WORKER_DATASET is not None) else make_dataset(args)
+
+    ckpt = torch.load(ckpt_path, map_location='cpu')
+    model = make_model(args['framework'], ckpt['config'])
+    model.load_state_dict(ckpt['model'])
+    model = model.to(args['device'])
+    model.eval()
+
+    def representation_function(x):
+        return model.encode(x.to(args['device']))
+
+    # the cached codes depend on the ground truth data as well as the checkpoint
+    session = EvaluationSession(dataset, representation_function, checkpoint_hash=f'{ckpt_hash}.{args["gt_data"]}',
+                                cache_dir=args['cache_dir'], num_points=args['num_points'],
+                                batch_size=args['batch_size'], seed=args['seed'])
+    metrics = FAST_METRICS if args['fast'] else DEFAULT_METRICS
+
+    rows = []
+    for metric_name in metric_names:
+        # every metric samples from the same seed, independent of which other metrics are computed
+        seed(args['seed'])
+        results = session.evaluate([metrics[metric_name]])
+        rows.append({
+            'checkpoint_hash': ckpt_hash,
+            'checkpoint': os.path.abspath(ckpt_path),
+            'epoch': ckpt.get('ep'),
+            'framework': args['framework'],
+            'gt_data': args['gt_data'],
+            'metric': metric_name,
+            'fast': args['fast'],
+            'seed': args['seed'],
+            'num_points': args['num_points'],
+            'results': {k: float(v) for k, v in results.items()},
+        })
+    return rows
+
+
+def main(args):
+    checkpoints = find_checkpoints(args['run_dir'])
+    results_path = args['results'] or os.path.join(args['run_dir'], 'metrics.jsonl')
+    done = load_results(results_path)
+
+    # only the metrics that are not in the results table yet are computed
+    tasks = []
+    for ckpt_path in checkpoints:
+        ckpt_hash = file_hash(ckpt_path)
+        metric_names = [m for m in args['metrics'] if result_key(ckpt_hash, m, args) not in done]
+        if metric_names:
+            tasks.append((ckpt_path, ckpt_hash, metric_names, args))
+    print(f'{len(checkpoints)} checkpoints in {args["run_dir"]}, {len(tasks)} to evaluate')
+    if not tasks:
+        return
+
+    if args['n_workers'] > 0:
+        pool = spawn_process_pool(args['n_workers'], initializer=_init_worker, initargs=(args,))
+        rows_iter = (future.result() for future in as_completed([pool.submit(evaluate_checkpoint, task) for task in tasks]))
+    else:
+        pool = None
+        rows_iter = map(evaluate_checkpoint, tasks)
+
+    # rows are appended as soon as a checkpoint is done, an interrupted sweep keeps all finished results
+    try:
+        with open(results_path, 'a') as f:
+            for rows in rows_iter:
+                for row in rows:
+                    f.write(json.dumps(row) + '\n')
+                f.flush()
+                print(f'{os.path.basename(rows[0]["checkpoint"])}: ' +
+                      ' '.join(f'{k}={v:.4f}' for row in rows for k, v in row['results'].items()))
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--run-dir', type=str, required=True,
+                        help='results directory of a run, or the directory with its %%05d.pth checkpoints')
+    parser.add_argument('--framework', type=str, required=True,
+                        choices=['betavae', 'adavae', 'adavae_orig', 'adacatvae'],
+                        help='framework the checkpoints were trained with, i.e. the train_disent_*.py script')
+    parser.add_argument('--gt-data', type=str, default='xysquares', choices=list(GT_DATA.keys()),
+                        help='ground truth data the metrics are computed on')
+    parser.add_argument('--metrics', type=str, nargs='+', default=list(DEFAULT_METRICS.keys()),
+                        choices=list(DEFAULT_METRICS.keys()), help='metrics to compute')
+    parser.add_argument('--fast', action='store_true', help='use the cheaper settings of FAST_METRICS')
+    parser.add_argument('--results', type=str, default=None,
+                        help='results table to append to, defaults to metrics.jsonl in the run directory')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='directory to cache the codes of each checkpoint in, codes are not cached by default')
+    parser.add_argument('--num-points', type=int, default=None,
+                        help='only sample from a fixed subset of the factor space of this size')
+    parser.add_argument('-bs', '--batch-size', type=int, default=64, help='batch size to encode the data')
+    parser.add_argument('--n-workers', type=int, default=0,
+                        help='number of checkpoints evaluated in parallel, 0 evaluates in the main process')
+    parser.add_argument('--device', type=str, default='cpu', help='device to be used')
+    parser.add_argument('-s', '--seed', type=int, default=777, help='seed')
+    return parser
+
+
+if __name__ == '__main__':
+    # e.g. python experiments/BaseVAEs/evaluate.py --run-dir experiments/BaseVAEs/runs/adavae-21-ecr \
+    #          --framework adavae --gt-data xysquares --metrics dci mig sap probing --n-workers 4
+    main(vars(_get_parser().parse_args(sys.argv[1:])))
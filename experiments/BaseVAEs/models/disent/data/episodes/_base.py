@@ -7,37 +7,52 @@ from BaseVAEs.models.disent.util import LengthIter
 
 class BaseOptionEpisodesData(LengthIter):
 
-    def __init__(self):
+    def __init__(self, contiguous: bool = False):
         self._episodes = self._load_episode_observations()
         assert len(self._episodes) > 0, 'There must be at least one episode!'
         # total length
         self._lengths = np.array([len(episode) for episode in self._episodes])
         self._length = np.sum(self._lengths)
         self._weights = self._lengths / self._length
+        # start of each episode and the total length, for binary searches over the episodes
+        self._offsets = np.concatenate([[0], np.cumsum(self._lengths)])
+        # store all the observations in one array, episodes are views of it
+        self._observations = None
+        if contiguous:
+            self._observations = np.concatenate(self._episodes)
+            self._episodes = [self._observations[start:end] for start, end in zip(self._offsets[:-1], self._offsets[1:])]
 
     def __len__(self):
         return self._length
 
     def __getitem__(self, idx):
-        # this can be slow!
         episode, idx, _ = self.get_episode_and_idx(idx)
         return episode[idx]
 
+    def get_batch(self, indices) -> np.ndarray:
+        if self._observations is not None:
+            return self._observations[np.asarray(indices)]
+        episode_ids, idxs, _ = self.batch_get_episode_and_idx(indices)
+        return np.stack([self._episodes[i][idx] for i, idx in zip(episode_ids, idxs)])
+
     def get_episode_and_idx(self, idx) -> Tuple[np.ndarray, int, int]:
-        assert idx >= 0, 'Negative indices are not supported.'
-        # linear search for episode & shift idx accordingly
-        # TODO: This could be better...
-        # TODO: add caching?
-        offset = 0
-        for episode in self._episodes:
-            length = len(episode)
-            if idx < length:
-                break
-            else:
-                offset += length
-                idx -= length
+        assert 0 <= idx < self._length, 'Negative or out of range indices are not supported.'
+        # binary search for episode & shift idx accordingly
+        i = np.searchsorted(self._offsets, idx, side='right') - 1
+        offset = int(self._offsets[i])
         # return found
-        return episode, idx, offset
+        return self._episodes[i], int(idx) - offset, offset
+
+    def batch_get_episode_and_idx(self, indices) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Batch version of get_episode_and_idx, returns the episode number,
+        the index within that episode and the offset of the episode for all indices.
+        """
+        indices = np.asarray(indices)
+        assert np.all((0 <= indices) & (indices < self._length)), 'Negative or out of range indices are not supported.'
+        episode_ids = np.searchsorted(self._offsets, indices, side='right') - 1
+        offsets = self._offsets[episode_ids]
+        return episode_ids, indices - offsets, offsets
 
     @staticmethod
     def sample_episode_indices(episode, idx, n=1, radius=None):
@@ -10,11 +10,11 @@ log = logging.getLogger(__file__)
 
 class OptionEpisodesPickledData(BaseOptionEpisodesData):
 
-    def __init__(self, required_file: str):
+    def __init__(self, required_file: str, contiguous: bool = False):
         assert os.path.isabs(required_file), f'{required_file=} must be an absolute path.'
         self._required_file = required_file
         # load data
-        super().__init__()
+        super().__init__(contiguous=contiguous)
 
     def _load_episode_observations(self) -> List[np.ndarray]:
         import pickle
@@ -83,9 +83,9 @@ class OptionEpisodesPickledData(BaseOptionEpisodesData):
 
 class OptionEpisodesDownloadZippedPickledData(OptionEpisodesPickledData):
 
-    def __init__(self, required_file: str, download_url=None, force_download=False):
+    def __init__(self, required_file: str, download_url=None, force_download=False, contiguous: bool = False):
         self._download_and_extract_if_needed(download_url=download_url, required_file=required_file, force_download=force_download)
-        super().__init__(required_file=required_file)
+        super().__init__(required_file=required_file, contiguous=contiguous)
 
     def _download_and_extract_if_needed(self, download_url: str, required_file: str, force_download: bool):
         # TODO: this function should probably be moved to the io file.
@@ -1,6 +1,7 @@
 import logging
-import numpy as np
+import os
 from BaseVAEs.models.disent.data.groundtruth.base import DownloadableGroundTruthData
+from BaseVAEs.models.disent.data.util.in_out import NpyMemmapReader, npz_extract_to_npy
 
 log = logging.getLogger(__name__)
 
@@ -44,21 +45,24 @@ class Mpi3dData(DownloadableGroundTruthData):
         # TODO: add support for converting to h5py for fast disk access
         assert in_memory, f'{in_memory=} is not yet supported'
         if in_memory:
-            log.warning('[WARNING]: mpi3d files are extremely large (over 11GB), you are trying to load these into memory.')
+            log.warning('[WARNING]: mpi3d files are extremely large (over 11GB), the images are memory mapped and held in memory once per node.')
 
         # initialise
         super().__init__(data_dir=data_dir, force_download=force_download)
 
-        # load data
-        if not hasattr(self.__class__, '_DATA'):
-            self.__class__._DATA = {}
-        if subset not in self.__class__._DATA:
-            self.__class__._DATA[subset] = np.load(self.dataset_paths[0])
-        self._data = self.__class__._DATA[subset]
+        # extract the images once into a raw npy file, which every process and instance memory maps,
+        # extracted again if the npz file was downloaded after the npy file was written
+        npy_path = f'{os.path.splitext(self.dataset_paths[0])[0]}_images.npy'
+        if not os.path.exists(npy_path) or (os.path.getmtime(npy_path) < os.path.getmtime(self.dataset_paths[0])):
+            npz_extract_to_npy(self.dataset_paths[0], 'images', npy_path)
+        self._data = NpyMemmapReader(npy_path)
 
     def __getitem__(self, idx):
         return self._data[idx]
 
+    def get_batch(self, indices):
+        return self._data.get_batch(indices)
+
 
 # ========================================================================= #
 # END                                                                       #
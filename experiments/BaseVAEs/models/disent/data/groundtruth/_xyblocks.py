@@ -115,6 +115,27 @@ class XYBlocksData(GroundTruthData):
         # RETURN
         return obs
 
+    def render_batch(self, indices) -> np.ndarray:
+        """Batch version of __getitem__, the blocks of each level are indexed for the whole batch at once."""
+        positions = self.idx_to_pos(np.asarray(indices))
+        cs, xs, ys = positions[:, :self._grid_dims*1], positions[:, self._grid_dims*1:self._grid_dims*2], positions[:, self._grid_dims*2:]
+        b = np.arange(len(positions))
+        colors = self._colors.astype(np.uint8)
+        # GENERATE
+        obs = np.full((len(positions), *self.observation_shape), self._bg_color, dtype=np.uint8)
+        for i, (d, s) in enumerate(zip(self._axis_divisions, self._axis_division_sizes)):
+            x, y, c = xs[:, i], ys[:, i], cs[:, i]
+            # view of the grid of blocks, indexed as [B, y, :, x, :, C]
+            blocks = obs.reshape(len(positions), d, s, d, s, -1)
+            # blocks are nested in the blocks of previous levels, so their first pixel is the colour of the whole block
+            fill = np.where(np.any(blocks[b, y, 0, x, 0] != colors[c], axis=-1)[:, None], colors[c], np.uint8(self._bg_color))
+            blocks[b, y, :, x] = fill[:, None, None, :]
+        # RETURN
+        return obs
+
+    def get_batch(self, indices) -> np.ndarray:
+        return self.render_batch(indices)
+
 
 # ========================================================================= #
 # END                                                                       #
@@ -106,6 +106,23 @@ class XYObjectData(GroundTruthData):
         obs[y:y+s, x:x+s] = self._colors[c]
         return obs
 
+    def render_batch(self, indices) -> np.ndarray:
+        """Batch version of __getitem__, the pixels of all the squares are indexed at once."""
+        x, y, s, c = self.idx_to_pos(np.asarray(indices)).T
+        s = self._square_scales[s]
+        r = (self._max_square_size - s) // 2
+        x, y = self._spacing*x + r, self._spacing*y + r
+        # pixels of each square within a window of the largest square
+        window = np.arange(self._max_square_size)
+        b, wy, wx = np.nonzero((window[None, :, None] < s[:, None, None]) & (window[None, None, :] < s[:, None, None]))
+        # GENERATE
+        obs = np.zeros((len(c), *self.observation_shape), dtype=np.uint8)
+        obs[b, y[b] + wy, x[b] + wx] = self._colors[c[b]]
+        return obs
+
+    def get_batch(self, indices) -> np.ndarray:
+        return self.render_batch(indices)
+
 
 # ========================================================================= #
 # END                                                                       #
@@ -68,6 +68,26 @@ class XYSquaresData(GroundTruthData):
                 obs[y:y+size, x:x+size, :] = 255
         return obs
 
+    def render_batch(self, indices) -> np.ndarray:
+        """Batch version of __getitem__, the pixels of each square are indexed for the whole batch at once."""
+        factors = self.idx_to_pos(np.asarray(indices))
+        offset, space, size = self._offset, self._spacing, self._square_size
+        b, r = np.arange(len(factors))[:, None, None], np.arange(size)
+        # GENERATE
+        obs = np.zeros((len(factors), *self.observation_shape), dtype=np.uint8)
+        for i in range(self._num_squares):
+            # squares can extend past the edge if they overlap, the slices of __getitem__ are clipped
+            x = np.minimum((offset + space * factors[:, 2*i])[:, None, None] + r[None, None, :], self._width - 1)
+            y = np.minimum((offset + space * factors[:, 2*i+1])[:, None, None] + r[None, :, None], self._width - 1)
+            if self._rgb:
+                obs[b, y, x, i] = 255
+            else:
+                obs[b, y, x, :] = 255
+        return obs
+
+    def get_batch(self, indices) -> np.ndarray:
+        return self.render_batch(indices)
+
 
 # ========================================================================= #
 # END                                                                       #
@@ -1,10 +1,13 @@
+import json
 import logging
 import os
 from abc import ABCMeta
 from typing import List, Tuple
 import h5py
+import numpy as np
 
-from BaseVAEs.models.disent.data.util.in_out import basename_from_url, download_file, ensure_dir_exists
+from BaseVAEs.models.disent.data.util.hdf5 import Hdf5BatchReader, hdf5_decode_to_npy
+from BaseVAEs.models.disent.data.util.in_out import NpyMemmapReader, basename_from_url, download_file, ensure_dir_exists
 from BaseVAEs.models.disent.data.util.state_space import StateSpace
 
 
@@ -50,6 +53,13 @@ class GroundTruthData(StateSpace):
     def __getitem__(self, idx):
         raise NotImplementedError
 
+    def get_batch(self, indices) -> np.ndarray:
+        """
+        Get the observations at the given indices, stacked along the first axis.
+        Override this if the data can be read or generated faster all at once.
+        """
+        return np.stack([self[idx] for idx in indices])
+
 
 # ========================================================================= #
 # dataset helpers                                                           #
@@ -162,41 +172,58 @@ class Hdf5PreprocessedGroundTruthData(PreprocessedDownloadableGroundTruthData, m
     TODO: Only supports one dataset from the hdf5 file itself, labels etc need a custom implementation.
     """
 
-    def __init__(self, data_dir='data/dataset', in_memory=False, force_download=False, force_preprocess=False):
+    def __init__(self, data_dir='data/dataset', in_memory=False, force_download=False, force_preprocess=False, tune_layout=False):
+        # used while preprocessing, which happens in the parent constructor
+        self._tune_layout = tune_layout
         super().__init__(data_dir=data_dir, force_download=force_download, force_preprocess=force_preprocess)
         self._in_memory = in_memory
 
-        # Load the entire dataset into memory if required
         if self._in_memory:
-            # Only load the dataset once, no matter how many instances of the class are created.
-            # data is stored on the underlying class at the _DATA property.
-            # TODO: this is weird
-            if not hasattr(self.__class__, '_DATA'):
-                log.info(f'[DATASET: {self.__class__.__name__}]: Loading...')
-                # Often the (non-chunked) dataset will be optimized for random accesses,
-                # while the unprocessed (chunked) dataset will be better for sequential reads.
-                with h5py.File(self.dataset_path, 'r') as db:
-                    # indexing dataset objects returns numpy array
-                    # instantiating np.array from the dataset requires double memory.
-                    self.__class__._DATA = db[self.hdf5_name][:]
-                log.info(f'[DATASET: {self.__class__.__name__}]: Loaded!')
+            # The dataset is decoded once into a raw npy file next to the processed file. Every process
+            # and instance memory maps that file, so the decoded data is held once by the page cache of
+            # the node, instead of once per process, and loading it never requires double memory.
+            if self._force_preprocess or not os.path.exists(self.dataset_path_npy) or (os.path.getmtime(self.dataset_path_npy) < os.path.getmtime(self.dataset_path)):
+                log.info(f'[DATASET: {self.__class__.__name__}]: Decoding...')
+                hdf5_decode_to_npy(self.dataset_path, self.hdf5_name, self.dataset_path_npy)
+                log.info(f'[DATASET: {self.__class__.__name__}]: Decoded!')
+            self._reader = NpyMemmapReader(self.dataset_path_npy)
+        else:
+            # the file is only opened on the first read, once per worker process
+            self._reader = Hdf5BatchReader(self.dataset_path, self.hdf5_name, cache_bytes=self.hdf5_chunk_cache_bytes)
 
     def __getitem__(self, idx):
-        if self._in_memory:
-            return self.__class__._DATA[idx]
-        else:
-            # This actually doesnt seem too slow
-            with h5py.File(self.dataset_path, 'r', libver='latest', swmr=True) as f:
-                return f[self.hdf5_name][idx]
+        return self._reader[idx]
+
+    def get_batch(self, indices) -> np.ndarray:
+        return self._reader.get_batch(indices)
+
+    @property
+    def dataset_path_npy(self):
+        """path of the decoded dataset, memory mapped if in_memory=True"""
+        return f'{self._proc_path}.{self.hdf5_name}.npy'
+
+    @property
+    def dataset_path_layout(self):
+        """path of the manifest of the layout chosen by tune_layout=True"""
+        return f'{self._proc_path}.layout.json'
 
     def _preprocess_dataset(self, path_src, path_dst):
-        import os
-        from disent.data.util.hdf5 import hdf5_resave_dataset, hdf5_test_entries_per_second, bytes_to_human
+        from BaseVAEs.models.disent.data.util.hdf5 import hdf5_resave_dataset, hdf5_test_entries_per_second, hdf5_tune_layout, bytes_to_human
 
         # resave datasets
         with h5py.File(path_src, 'r') as inp_data:
+            chunks, compression, compression_opts = self.hdf5_chunk_size, self.hdf5_compression, self.hdf5_compression_lvl
+            # choose the layout with the best throughput for the access pattern of training
+            if self._tune_layout:
+                access_method, batch_size = self.hdf5_tune_access_pattern
+                log.info(f'[TUNING] Chunk Layout for {access_method} accesses in batches of {batch_size}...')
+                layouts = hdf5_tune_layout(inp_data, self.hdf5_name, access_method=access_method, batch_size=batch_size, max_size_ratio=self.hdf5_tune_max_size_ratio, temp_dir=os.path.dirname(path_dst))
+                chunks, compression, compression_opts = tuple(layouts[0]['chunks']), layouts[0]['compression'], layouts[0]['compression_opts']
+                with open(self.dataset_path_layout, 'w') as f:
+                    json.dump(dict(source=os.path.basename(path_src), dataset=self.hdf5_name, access_method=access_method, batch_size=batch_size, max_size_ratio=self.hdf5_tune_max_size_ratio, layout=layouts[0], candidates=layouts), f, indent=2)
+                log.info(f'[TUNING] Chose chunks={chunks} compression={compression} compression_opts={compression_opts}, saved to: {self.dataset_path_layout}')
             with h5py.File(path_dst, 'w') as out_data:
-                hdf5_resave_dataset(inp_data, out_data, self.hdf5_name, self.hdf5_chunk_size, self.hdf5_compression, self.hdf5_compression_lvl)
+                hdf5_resave_dataset(inp_data, out_data, self.hdf5_name, chunks, compression, compression_opts)
                 # File Size:
                 log.info(f'[FILE SIZES] IN: {bytes_to_human(os.path.getsize(path_src))} OUT: {bytes_to_human(os.path.getsize(path_dst))}\n')
                 # Test Speed:
@@ -212,6 +239,21 @@ class Hdf5PreprocessedGroundTruthData(PreprocessedDownloadableGroundTruthData, m
         # default is 4, max of 9 doesnt seem to add much cpu usage on read, but its not worth it data wise?
         return 4
 
+    @property
+    def hdf5_tune_access_pattern(self) -> Tuple[str, int]:
+        # access method and batch size that tune_layout optimises for, random batches as read by GroundTruthBatchDataset
+        return 'random', 256
+
+    @property
+    def hdf5_tune_max_size_ratio(self) -> float:
+        # tune_layout only chooses layouts up to this many times larger than the smallest one
+        return 4
+
+    @property
+    def hdf5_chunk_cache_bytes(self) -> int:
+        # size of the LRU cache of decompressed chunks, per worker process
+        return 128 * 1024**2
+
     @property
     def hdf5_name(self) -> str:
         raise NotImplementedError()
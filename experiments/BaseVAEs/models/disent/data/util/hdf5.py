@@ -1,5 +1,9 @@
 import math
+import os
+import tempfile
 import time
+from collections import OrderedDict
+import h5py
 import numpy as np
 from tqdm import tqdm
 
@@ -20,7 +24,7 @@ def bytes_to_human(size_bytes, decimals=3, color=True):
     size_color = (None,     92,   93,    91,    91,    91,    91,    91,    91)
     i = int(math.floor(math.log(size_bytes, 1024)))
     s = round(size_bytes / math.pow(1024, i), decimals)
-    name = f'\033[{size_color[i]}m{size_name[i]}\033[0m' if color else size_name[i]
+    name = f'\033[{size_color[i]}m{size_name[i]}\033[0m' if (color and size_color[i]) else size_name[i]
     return f"{s:{4+decimals}.{decimals}f} {name}"
 
 
@@ -91,7 +95,7 @@ def hdf5_resave_dataset(inp_data, out_data, dataset, chunks=None, compression=No
         tqdm.write('')
 
 
-def hdf5_test_entries_per_second(data, dataset, access_method='random', max_entries=48000, timeout=10):
+def hdf5_test_entries_per_second(data, dataset, access_method='random', max_entries=48000, timeout=10, batch_size=None):
     # num entries to test
     n = min(len(data[dataset]), max_entries)
 
@@ -106,15 +110,193 @@ def hdf5_test_entries_per_second(data, dataset, access_method='random', max_entr
 
     # iterate through dataset, exit on timeout or max_entries
     start_time = time.time()
-    for i, idx in enumerate(indices):
-        entry = data[dataset][idx]
-        if time.time() - start_time > timeout or i >= max_entries:
-            break
+    if batch_size is None:
+        for i, idx in enumerate(indices):
+            entry = data[dataset][idx]
+            if time.time() - start_time > timeout or i >= max_entries:
+                break
+    else:
+        # batches of indices, sorted as h5py only supports increasing indices
+        for i in range(batch_size - 1, n + batch_size - 1, batch_size):
+            entries = data[dataset][np.sort(indices[i - batch_size + 1:i + 1])]
+            if time.time() - start_time > timeout:
+                break
+        i = min(i, n - 1)
 
     # calculate score
     entries_per_sec = (i + 1) / (time.time() - start_time)
     return entries_per_sec
 
+
+def hdf5_tune_layout(inp_data, dataset, chunk_lens=(1, 4, 16, 64), compressions=((None, None), ('lzf', None), ('gzip', 1), ('gzip', 4), ('gzip', 9)), num_samples=8192, access_method='random', batch_size=None, max_size_ratio=None, timeout=1, temp_dir=None):
+    """
+    Resave a contiguous sample of the dataset with every combination of chunk length (entries per chunk)
+    and compression, measure its size and the random and sequential accesses per second through
+    Hdf5BatchReader with hdf5_test_entries_per_second. Returns the results of all layouts, sorted by the
+    throughput of the given access method and batch size, ie. the access pattern the data is trained with.
+    Layouts larger than max_size_ratio times the smallest layout are sorted last, as reads from the page
+    cache always favour no compression, no matter how large the file gets.
+    """
+    n = len(inp_data[dataset])
+    start = np.random.randint(0, max(n - num_samples, 0) + 1)
+    sample = inp_data[dataset][start:start + num_samples]
+    # a batch of the sample should hit as many entries per chunk as a batch of the whole dataset,
+    # otherwise longer chunks appear faster than they are
+    if batch_size is not None:
+        batch_size = max(1, round(batch_size * len(sample) / n))
+    results = []
+    with tempfile.TemporaryDirectory(dir=temp_dir) as temp_dir:
+        for chunk_len in chunk_lens:
+            for compression, compression_opts in compressions:
+                path = os.path.join(temp_dir, f'{chunk_len}_{compression}_{compression_opts}.h5')
+                chunks = (min(chunk_len, len(sample)), *sample.shape[1:])
+                with h5py.File(path, 'w') as out_data:
+                    out_data.create_dataset(name=dataset, data=sample, chunks=chunks, compression=compression, compression_opts=compression_opts)
+                reader = Hdf5BatchReader(path, dataset, cache_bytes=0)
+                results.append(dict(
+                    chunks=list(chunks),
+                    compression=compression,
+                    compression_opts=compression_opts,
+                    bytes_per_entry=os.path.getsize(path) / len(sample),
+                    random=hdf5_test_entries_per_second({dataset: reader}, dataset, access_method='random', timeout=timeout, batch_size=batch_size),
+                    sequential=hdf5_test_entries_per_second({dataset: reader}, dataset, access_method='sequential', timeout=timeout, batch_size=batch_size),
+                ))
+                tqdm.write(f'[{str(chunks):18s} {str(compression):4s} {str(compression_opts):4s}] size per entry: \033[93m{bytes_to_human(results[-1]["bytes_per_entry"])}\033[0m random: \033[91m{results[-1]["random"]:9.1f}\033[0m sequential: \033[91m{results[-1]["sequential"]:9.1f}\033[0m entries/s')
+                del reader
+    max_bytes = min(r['bytes_per_entry'] for r in results) * (max_size_ratio or np.inf)
+    return sorted(results, key=lambda r: (r['bytes_per_entry'] > max_bytes, -r[access_method]))
+
+
+def hdf5_decode_to_npy(h5_path, h5_dataset_name, npy_path, batch_size=None):
+    """
+    Decode a dataset of an hdf5 file into a raw npy file, in batches of
+    whole chunks, so that the full array is never held in memory.
+    """
+    from BaseVAEs.models.disent.data.util.in_out import temp_path_for
+    temp_path = temp_path_for(npy_path)
+    with h5py.File(h5_path, 'r') as f:
+        dataset = f[h5_dataset_name]
+        if batch_size is None:
+            # whole chunks of about 64 MiB
+            chunk_len = dataset.chunks[0] if dataset.chunks else 1
+            chunk_bytes = chunk_len * dataset.dtype.itemsize * int(np.prod(dataset.shape[1:]))
+            batch_size = chunk_len * max(1, 64 * 1024**2 // chunk_bytes)
+        out = np.lib.format.open_memmap(temp_path, mode='w+', dtype=dataset.dtype, shape=dataset.shape)
+        for i in tqdm(range(0, len(dataset), batch_size), desc=f'Decoding "{h5_dataset_name}"'):
+            out[i:i + batch_size] = dataset[i:i + batch_size]
+        out.flush()
+        del out
+    os.rename(temp_path, npy_path)
+
+
+# ========================================================================= #
+# hdf5 reader                                                               #
+# ========================================================================= #
+
+
+class Hdf5BatchReader(object):
+    """
+    Read only access to a dataset of an hdf5 file, that keeps its file open
+    instead of opening it for every access.
+    - The file is opened lazily, once per process. Handles are not shared
+      with forked workers, and are not pickled for spawned workers.
+    - get_batch reads the chunks of a batch of indices in sorted order and
+      reads every chunk only once, even if it contains several of the indices.
+    - Decompressed chunks are kept in an LRU cache of up to cache_bytes,
+      chunks span entries along the first axis only.
+    """
+
+    def __init__(self, h5_path: str, h5_dataset_name: str, cache_bytes: int = 128 * 1024**2):
+        self._h5_path = h5_path
+        self._h5_dataset_name = h5_dataset_name
+        self._cache_bytes = cache_bytes
+        # read the meta data with a temporary handle, so that nothing is open yet
+        with h5py.File(h5_path, 'r', libver='latest', swmr=True) as f:
+            dataset = f[h5_dataset_name]
+            self._shape, self._dtype = dataset.shape, dataset.dtype
+            assert (dataset.chunks is None) or all(c == s for c, s in zip(dataset.chunks[1:], dataset.shape[1:])), f'chunks must span whole entries: {dataset.chunks=}'
+            self._chunk_len = dataset.chunks[0] if dataset.chunks else 1
+        self._init_handle()
+
+    def _init_handle(self):
+        self._file, self._dataset, self._pid = None, None, None
+        self._cache, self._cache_used = OrderedDict(), 0
+
+    def __getstate__(self):
+        # h5py handles cannot be pickled, spawned workers open their own
+        state = self.__dict__.copy()
+        for k in ('_file', '_dataset', '_pid', '_cache', '_cache_used'):
+            del state[k]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_handle()
+
+    def _get_dataset(self):
+        # reopen after a fork, the inherited handle belongs to the parent
+        if self._pid != os.getpid():
+            self._file = h5py.File(self._h5_path, 'r', libver='latest', swmr=True)
+            self._dataset = self._file[self._h5_dataset_name]
+            self._pid = os.getpid()
+        return self._dataset
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    def __len__(self):
+        return self._shape[0]
+
+    def __getitem__(self, idx):
+        if np.ndim(idx) == 0:
+            return self.get_batch([idx])[0]
+        return self.get_batch(idx)
+
+    def get_batch(self, indices) -> np.ndarray:
+        """
+        Read the entries at the given indices, returned in the same order.
+        Indices can be unsorted, negative and contain duplicates.
+        """
+        indices = np.asarray(indices, dtype='int64').reshape(-1)
+        # wrap negative indices like numpy, out of range indices would otherwise map to wrong or missing chunks
+        wrapped = np.where(indices < 0, indices + len(self), indices)
+        out_of_range = (wrapped < 0) | (wrapped >= len(self))
+        if np.any(out_of_range):
+            raise IndexError(f'indices out of range for dataset of length {len(self)}: {indices[out_of_range].tolist()}')
+        indices = wrapped
+        chunk_ids, chunk_inverse = np.unique(indices // self._chunk_len, return_inverse=True)
+        # get cached chunks and read the missing chunks, in increasing order
+        chunks = {}
+        for chunk_id in chunk_ids:
+            if chunk_id in self._cache:
+                self._cache.move_to_end(chunk_id)
+                chunks[chunk_id] = self._cache[chunk_id]
+        missing = chunk_ids[[chunk_id not in chunks for chunk_id in chunk_ids]]
+        if len(missing) > 0:
+            dataset = self._get_dataset()
+            # one slice per chunk, h5py point selections of many indices are slower than reading them one by one
+            for chunk_id in missing:
+                chunks[chunk_id] = dataset[chunk_id * self._chunk_len:(chunk_id + 1) * self._chunk_len]
+        # gather the entries
+        batch = np.empty((len(indices), *self._shape[1:]), dtype=self._dtype)
+        offsets = indices % self._chunk_len
+        for i, chunk_id in enumerate(chunk_ids):
+            mask = (chunk_inverse == i)
+            batch[mask] = chunks[chunk_id][offsets[mask]]
+        # update the cache, evicting the least recently used chunks
+        for chunk_id in missing:
+            self._cache[chunk_id] = chunks[chunk_id]
+            self._cache_used += chunks[chunk_id].nbytes
+        while self._cache_used > self._cache_bytes and self._cache:
+            self._cache_used -= self._cache.popitem(last=False)[1].nbytes
+        return batch
+
+
 # ========================================================================= #
 # END                                                                       #
 # ========================================================================= #
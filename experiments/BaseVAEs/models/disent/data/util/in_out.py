@@ -78,6 +78,72 @@ def download_file(url, save_path=None, overwrite_existing=False, chunk_size=4096
     os.rename(temp_download_path, save_path)
 
 
+def temp_path_for(path):
+    """temporary path to write a file to before renaming it, unique per process"""
+    import os
+    path_dir, path_base = os.path.split(path)
+    ensure_dir_exists(path_dir)
+    return os.path.join(path_dir, f'.{path_base}.{os.getpid()}.temp')
+
+
+def npz_extract_to_npy(npz_path, key, npy_path):
+    """
+    Extract a single array from an npz archive into a raw npy file, without
+    loading it into memory. Members of npz archives are stored as npy files.
+    """
+    import os
+    import shutil
+    import zipfile
+    log.info(f'extracting "{key}" from "{npz_path}" to "{npy_path}"')
+    temp_path = temp_path_for(npy_path)
+    with zipfile.ZipFile(npz_path) as zf, zf.open(f'{key}.npy') as src, open(temp_path, 'wb') as dst:
+        shutil.copyfileobj(src, dst, length=16 * 1024**2)
+    os.rename(temp_path, npy_path)
+
+
+# ========================================================================= #
+# npy memmap                                                                #
+# ========================================================================= #
+
+
+class NpyMemmapReader(object):
+    """
+    Read only memory map of a raw npy file, opened lazily once per process.
+    All processes and instances that map the same file share its pages in
+    the page cache, so the data is held in memory once per node, instead of
+    once per process after copy-on-write faults in forked workers.
+    The map is not pickled, spawned workers map the file themselves.
+    """
+
+    def __init__(self, npy_path: str):
+        self._npy_path = npy_path
+        self._data = None
+
+    def __getstate__(self):
+        # pickling a memmap would copy the whole array
+        return {**self.__dict__, '_data': None}
+
+    def _get_data(self):
+        if self._data is None:
+            import numpy as np
+            self._data = np.load(self._npy_path, mmap_mode='r')
+        return self._data
+
+    @property
+    def shape(self):
+        return self._get_data().shape
+
+    def __len__(self):
+        return len(self._get_data())
+
+    def __getitem__(self, idx):
+        return self._get_data()[idx]
+
+    def get_batch(self, indices):
+        import numpy as np
+        return self._get_data()[np.asarray(indices)]
+
+
 # ========================================================================= #
 # END                                                                       #
 # ========================================================================= #
@@ -133,6 +133,34 @@ class StateSpace(LengthIter):
         """
         return self.sample_missing_factors(np.array(factors)[..., fixed_factor_indices], fixed_factor_indices)
 
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    # Batch Sampling Functions - masks differ per row                       #
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+
+    def sample_factor_masks(self, num_true) -> np.ndarray:
+        """
+        Sample boolean masks over the factors, with exactly num_true[i] randomly
+        chosen factors set in row i, ie. the batch version of choosing a random
+        subset of factor indices with np.random.choice(num_factors, k, replace=False).
+
+        - num_true is an integer array of shape (*size,) with values in [0, num_factors]
+        - returned masks have the shape (*size, num_factors)
+        """
+        num_true = np.asarray(num_true)
+        # the rank of each factor in a random permutation of each row
+        ranks = np.argsort(np.argsort(np.random.random((*num_true.shape, self.num_factors)), axis=-1), axis=-1)
+        return ranks < num_true[..., None]
+
+    def resample_factors_masked(self, factors, fixed_mask) -> np.ndarray:
+        """
+        Resample across all the factors, keeping the factors where fixed_mask is True constant.
+        Unlike resample_factors, the fixed factors can differ between rows of a batch.
+
+        - factors and fixed_mask have the shape (*size, num_factors)
+        """
+        factors = np.asarray(factors)
+        return np.where(fixed_mask, factors, self.sample_factors(size=factors.shape[:-1]))
+
 
 # ========================================================================= #
 # Hidden State Space                                                        #
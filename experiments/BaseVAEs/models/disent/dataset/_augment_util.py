@@ -20,6 +20,9 @@ class AugmentableDataset(object):
     def _get_augmentable_observation(self, idx):
         raise NotImplementedError
 
+    def _get_augmentable_observations(self, indices):
+        return [self._get_augmentable_observation(idx) for idx in indices]
+
     def __len__(self):
         raise NotImplementedError
 
@@ -46,8 +49,9 @@ class AugmentableDataset(object):
         except:
             raise TypeError(f'Indices must be integer-like ({type(idx)}): {idx}')
         # we do not support indexing by lists
-        dat = self._get_augmentable_observation(idx)
-        # return correct data
+        return self._datapoint_from_raw(self._get_augmentable_observation(idx), mode=mode)
+
+    def _datapoint_from_raw(self, dat, mode: str):
         if mode == 'pair':
             x_targ = self._datapoint_raw_to_target(dat)
             x = self._datapoint_target_to_input(x_targ)
@@ -79,7 +83,8 @@ class AugmentableDataset(object):
 
     def dataset_batch_from_indices(self, indices: List[int], mode: str):
         """Get a batch of observations X from a batch of factors Y."""
-        return default_collate([self.dataset_get(idx, mode=mode) for idx in indices])
+        # the raw observations are obtained all at once
+        return default_collate([self._datapoint_from_raw(dat, mode=mode) for dat in self._get_augmentable_observations(indices)])
 
     def dataset_sample_batch(self, num_samples: int, mode: str):
         """Sample a batch of observations X."""
@@ -38,6 +38,9 @@ class RandomEpisodeDataset(Dataset, LengthIter, AugmentableDataset):
     def _get_augmentable_observation(self, idx):
         return self._episodes[idx]
 
+    def _get_augmentable_observations(self, indices):
+        return self._episodes.get_batch(indices)
+
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
     # Sampling                                                              #
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
@@ -47,11 +50,13 @@ class RandomEpisodeDataset(Dataset, LengthIter, AugmentableDataset):
 
     def __getitem__(self, idx):
         # sample for observations
-        episode, idx, offset = self._episodes.get_episode_and_idx(idx)
+        episode, idx, _ = self._episodes.get_episode_and_idx(idx)
         indices = self._episodes.sample_episode_indices(episode, idx, n=self._num_samples, radius=self._sample_radius)
-        # transform back to original indices
-        indices = [i + offset for i in indices]
-        # TODO: this is inefficient, we have to perform multiple searches for the same thing!
-        return self.dataset_get_observation(*indices)
+        # the observations are taken from the episode that was found, instead of searching for each again
+        xs, x_targs = zip(*[self._datapoint_from_raw(episode[i], mode='pair') for i in indices])
+        return {
+            'x': tuple(xs),
+            'x_targ': tuple(x_targs),
+        }
 
 
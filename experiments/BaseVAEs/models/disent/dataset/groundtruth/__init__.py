@@ -2,3 +2,5 @@ from ._single import GroundTruthDataset
 from ._pair import GroundTruthDatasetPairs
 from ._pair_weak import GroundTruthDatasetOrigWeakPairs
 from ._triplet import GroundTruthDatasetTriples
+# batches
+from ._batch import GroundTruthBatchDataset, RandomBatchSampler
@@ -0,0 +1,64 @@
+import torch
+from torch.utils.data import Dataset, Sampler
+from BaseVAEs.models.disent.dataset.groundtruth._single import GroundTruthDataset
+
+
+# ========================================================================= #
+# batches of ground truth datapoints                                        #
+# ========================================================================= #
+
+
+class GroundTruthBatchDataset(Dataset):
+    """
+    Wraps a GroundTruthDataset, or its pair and triplet versions, such that indexing
+    with an array of indices returns a whole, ready batch via batch_get_observation,
+    ie. the factors of all the datapoints of a batch are sampled at once instead of
+    once per __getitem__. Meant to be used with RandomBatchSampler as sampler and
+    batch_size=None in the DataLoader:
+
+        DataLoader(GroundTruthBatchDataset(dataset), sampler=RandomBatchSampler(len(dataset), batch_size), batch_size=None)
+
+    All other attributes are taken from the wrapped dataset.
+    """
+
+    def __init__(self, dataset: GroundTruthDataset):
+        self.dataset = dataset
+
+    def __getitem__(self, indices):
+        return self.dataset.batch_get_observation(indices)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getattr__(self, name):
+        # guard against recursion while unpickling, when self.dataset is not yet set
+        if name == 'dataset':
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+
+class RandomBatchSampler(Sampler):
+    """
+    Yields the index arrays of consecutive batches of a random permutation, ie. the
+    batch level equivalent of shuffle=True.
+    """
+
+    def __init__(self, num_samples: int, batch_size: int, drop_last: bool = False):
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        perm = torch.randperm(self.num_samples).numpy()
+        for start in range(0, len(self) * self.batch_size, self.batch_size):
+            yield perm[start:start + self.batch_size]
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+
+# ========================================================================= #
+# END                                                                       #
+# ========================================================================= #
@@ -62,13 +62,21 @@ class GroundTruthDatasetPairs(GroundTruthDataset):
         We study both the case where k is constant across all pairs in the data set and where k is sampled uniformly in the range [d − 1] for every training pair (k = Rnd in the following).
         Unless specified otherwise, we aggregate the results for all values of k.
         """
+        anchor_factors, positive_factors = self.batch_sample_factors([idx])
+        return anchor_factors[0], positive_factors[0]
+
+    def batch_sample_factors(self, indices):
+        """
+        Batch version of datapoint_sample_factors_pair, the number of differing
+        factors, which factors differ and their new values are sampled for all
+        the pairs at once. Returns the anchor and positive factors [B, num_factors].
+        """
         # SAMPLE FACTOR INDICES
-        p_k = self._sample_num_factors()
-        p_shared_indices = self._sample_shared_indices(p_k)
+        p_k = self._sample_num_factors(size=len(indices))
+        p_shared_mask = self._sample_shared_mask(p_k)
         # SAMPLE FACTORS - sample, resample and replace shared factors with originals
-        anchor_factors = self.data.idx_to_pos(idx)
-        positive_factors = self._resample_factors(anchor_factors)
-        positive_factors[p_shared_indices] = anchor_factors[p_shared_indices]
+        anchor_factors = self.data.idx_to_pos(np.asarray(indices))
+        positive_factors = np.where(p_shared_mask, anchor_factors, self._resample_factors(anchor_factors))
         return anchor_factors, positive_factors
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
@@ -84,13 +92,13 @@ class GroundTruthDatasetPairs(GroundTruthDataset):
                                   f'\n\tUnsatisfied: {p_max} <= {np.array(max_values)}')
         return p_min, p_max
 
-    def _sample_num_factors(self):
-        p_k = np.random.randint(self.p_k_min, self.p_k_max + 1)
+    def _sample_num_factors(self, size=None):
+        p_k = np.random.randint(self.p_k_min, self.p_k_max + 1, size=size)
         return p_k
 
-    def _sample_shared_indices(self, p_k):
-        p_shared_indices = np.random.choice(self.data.num_factors, size=self.data.num_factors-p_k, replace=False)
-        return p_shared_indices
+    def _sample_shared_mask(self, p_k):
+        p_shared_mask = self.data.sample_factor_masks(self.data.num_factors - p_k)
+        return p_shared_mask
 
     def _resample_factors(self, anchor_factors):
         positive_factors = sample_radius(anchor_factors, low=0, high=self.data.factor_sizes, r_low=self.p_radius_min, r_high=self.p_radius_max + 1)
@@ -37,10 +37,18 @@ class GroundTruthDatasetOrigWeakPairs(GroundTruthDataset):
         This function is based on _sample_weak_pair_factors()
         Except deterministic for the first item in the pair, based off of idx.
         """
+        sampled_factors, next_factors = self.batch_sample_factors([idx])
+        return sampled_factors[0], next_factors[0]
+
+    def batch_sample_factors(self, indices):
+        """
+        Batch version of datapoint_sample_factors_pair, the differing
+        factors of all the pairs are sampled at once.
+        """
         # randomly sample the first observation -- In our case we just use the idx
-        sampled_factors = self.data.idx_to_pos(idx)
+        sampled_factors = self.data.idx_to_pos(np.asarray(indices))
         # sample the next observation with k differing factors
-        next_factors, k = _sample_k_differing(sampled_factors, self.data, k=self.p_k)
+        next_factors, k = _batch_sample_k_differing(sampled_factors, self.data, k=self.p_k)
         # return the samples
         return sampled_factors, next_factors
 
@@ -71,6 +79,23 @@ def _sample_k_differing(factors, ground_truth_data: GroundTruthData, k=1):
     return factors, k
 
 
+def _batch_sample_k_differing(factors, ground_truth_data: GroundTruthData, k=1):
+    """
+    Batch version of _sample_k_differing, resamples the factors [B, num_factors]
+    of all the pairs at once, the number of differing factors k is sampled per pair.
+    """
+    factors = np.asarray(factors)
+    assert factors.ndim == 2
+    # sample k
+    if k <= 0:
+        k = np.random.randint(1, ground_truth_data.num_factors, size=len(factors))
+    # randomly choose 1 or k, see _sample_k_differing
+    k = np.where(np.random.random(len(factors)) < 0.5, 1, k)
+    # randomly update k factors of every row
+    differing_mask = ground_truth_data.sample_factor_masks(k)
+    return np.where(differing_mask, ground_truth_data.sample_factors(size=len(factors)), factors), k
+
+
 def _sample_weak_pair_factors(gt_data: GroundTruthData):
     """
     Sample a weakly supervised pair from the given GroundTruthData.
@@ -42,6 +42,9 @@ class GroundTruthDataset(Dataset, GroundTruthData, AugmentableDataset):
     def _get_augmentable_observation(self, idx):
         return self.data[idx]
 
+    def _get_augmentable_observations(self, indices):
+        return self.data.get_batch(indices)
+
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
     # State Space Overrides                                                 #
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
@@ -82,6 +85,36 @@ class GroundTruthDataset(Dataset, GroundTruthData, AugmentableDataset):
         batch = self.dataset_batch_from_factors(factors, mode=mode)
         return batch
 
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    # Batches of Datapoints                                                 #
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+
+    def batch_sample_factors(self, indices) -> Tuple[np.ndarray, ...]:
+        """
+        Sample the factors of every observation of the datapoints at the given indices,
+        ie. one [B, num_factors] array per observation, a single one here, two for pairs
+        and three for triplets. This is the batch version of the datapoint_sample_factors_*
+        functions of the subclasses.
+        """
+        return (self.idx_to_pos(np.asarray(indices)),)
+
+    def batch_sample_indices(self, indices) -> np.ndarray:
+        """State space indices [B, num_observations] of the observations of the datapoints at the given indices."""
+        return np.stack([self.pos_to_idx(factors) for factors in self.batch_sample_factors(indices)], axis=1)
+
+    def batch_get_observation(self, indices):
+        """
+        Batch version of __getitem__, the result has the same structure as
+        default_collate([self[idx] for idx in indices]), but the factors of
+        all the datapoints are sampled at once.
+        """
+        obs_indices = self.batch_sample_indices(indices)
+        xs, x_targs = zip(*(self.dataset_batch_from_indices(obs_indices[:, i], mode='pair') for i in range(obs_indices.shape[1])))
+        return {
+            'x': list(xs),
+            'x_targ': list(x_targs),
+        }
+
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
     # End Class                                                             #
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
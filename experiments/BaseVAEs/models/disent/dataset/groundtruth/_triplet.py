@@ -75,21 +75,29 @@ class GroundTruthDatasetTriples(GroundTruthDataset):
         )
 
     def datapoint_sample_factors_triplet(self, idx):
+        anchor_factors, positive_factors, negative_factors = self.batch_sample_factors([idx])
+        return anchor_factors[0], positive_factors[0], negative_factors[0]
+
+    def batch_sample_factors(self, indices):
+        """
+        Batch version of datapoint_sample_factors_triplet, all the triplets are
+        sampled at once. Returns the anchor, positive and negative factors [B, num_factors].
+        """
         # SAMPLE FACTOR INDICES
-        p_k, n_k = self._sample_num_factors()
-        p_shared_indices, n_shared_indices = self._sample_shared_indices(p_k, n_k)
+        p_k, n_k = self._sample_num_factors(size=len(indices))
+        p_shared_mask, n_shared_mask = self._sample_shared_mask(p_k, n_k)
         # SAMPLE FACTORS - sample, resample and replace shared factors with originals
-        anchor_factors = self.data.idx_to_pos(idx)
+        anchor_factors = self.data.idx_to_pos(np.asarray(indices))
         positive_factors, negative_factors = self._resample_factors(anchor_factors)
-        positive_factors[p_shared_indices] = anchor_factors[p_shared_indices]
-        negative_factors[n_shared_indices] = anchor_factors[n_shared_indices]
+        positive_factors = np.where(p_shared_mask, anchor_factors, positive_factors)
+        negative_factors = np.where(n_shared_mask, anchor_factors, negative_factors)
         # SWAP IF +VE FURTHER THAN -VE
         if self._swap_metric is not None:
             positive_factors, negative_factors = self._swap_factors(anchor_factors, positive_factors, negative_factors)
         # RANDOMLY SWAP +ve AND -ve IF CHANCE:
         if self._swap_chance is not None:
-            if np.random.random() < self._swap_chance:
-                positive_factors, negative_factors = negative_factors, positive_factors
+            swap = (np.random.random(len(indices)) < self._swap_chance)[:, None]
+            positive_factors, negative_factors = np.where(swap, negative_factors, positive_factors), np.where(swap, positive_factors, negative_factors)
         # return factors!
         return anchor_factors, positive_factors, negative_factors
 
@@ -135,29 +143,32 @@ class GroundTruthDatasetTriples(GroundTruthDataset):
         # we're done!
         return p_min, p_max, n_min, n_max
 
-    def _sample_num_factors(self):
-        p_k = np.random.randint(self.p_k_min, self.p_k_max + 1)
+    def _sample_num_factors(self, size=None):
+        p_k = np.random.randint(self.p_k_min, self.p_k_max + 1, size=size)
         # sample for negative
         if self.n_k_sample_mode == 'offset':
-            n_k = np.random.randint(p_k + self.n_k_min, min(p_k + self.n_k_max, self.data.num_factors) + 1)
+            n_k = np.random.randint(p_k + self.n_k_min, np.minimum(p_k + self.n_k_max, self.data.num_factors) + 1)
         elif self.n_k_sample_mode == 'bounded_below':
-            n_k = np.random.randint(max(p_k, self.n_k_min), self.n_k_max + 1)
+            n_k = np.random.randint(np.maximum(p_k, self.n_k_min), self.n_k_max + 1)
         elif self.n_k_sample_mode == 'random':
-            n_k = np.random.randint(self.n_k_min, self.n_k_max + 1)
+            n_k = np.random.randint(self.n_k_min, self.n_k_max + 1, size=size)
         else:
             raise KeyError(f'Unknown mode: {self.n_k_sample_mode=}')
         # we're done!
         return p_k, n_k
 
-    def _sample_shared_indices(self, p_k, n_k):
-        p_shared_indices = np.random.choice(self.data.num_factors, size=self.data.num_factors-p_k, replace=False)
+    def _sample_shared_mask(self, p_k, n_k):
+        # the rank of each factor in a random permutation, the first num_factors-k factors are shared
+        ranks = np.argsort(np.argsort(np.random.random((len(p_k), self.data.num_factors)), axis=-1), axis=-1)
+        p_shared_mask = ranks < (self.data.num_factors - p_k)[:, None]
         # sample for negative
         if self.n_k_is_shared:
-            n_shared_indices = p_shared_indices[:self.data.num_factors-n_k]
+            # subset of the positive shared factors, which limits the number if n_k < p_k
+            n_shared_mask = ranks < (self.data.num_factors - np.maximum(n_k, p_k))[:, None]
         else:
-            n_shared_indices = np.random.choice(self.data.num_factors, size=self.data.num_factors-n_k, replace=False)
+            n_shared_mask = self.data.sample_factor_masks(self.data.num_factors - n_k)
         # we're done!
-        return p_shared_indices, n_shared_indices
+        return p_shared_mask, n_shared_mask
 
     def _resample_factors(self, anchor_factors):
         # sample positive
@@ -183,26 +194,25 @@ class GroundTruthDatasetTriples(GroundTruthDataset):
 
     def _swap_factors(self, anchor_factors, positive_factors, negative_factors):
         if self._swap_metric == 'k':
-            p_dist = np.sum(anchor_factors == positive_factors)
-            n_dist = np.sum(anchor_factors == negative_factors)
+            p_dist = np.sum(anchor_factors == positive_factors, axis=-1)
+            n_dist = np.sum(anchor_factors == negative_factors, axis=-1)
         elif self._swap_metric == 'manhattan':
-            p_dist = np.sum(np.abs(anchor_factors - positive_factors))
-            n_dist = np.sum(np.abs(anchor_factors - negative_factors))
+            p_dist = np.sum(np.abs(anchor_factors - positive_factors), axis=-1)
+            n_dist = np.sum(np.abs(anchor_factors - negative_factors), axis=-1)
         elif self._swap_metric == 'manhattan_norm':
-            p_dist = np.sum(np.abs((anchor_factors - positive_factors) / np.subtract(self.data.factor_sizes, 1)))
-            n_dist = np.sum(np.abs((anchor_factors - negative_factors) / np.subtract(self.data.factor_sizes, 1)))
+            p_dist = np.sum(np.abs((anchor_factors - positive_factors) / np.subtract(self.data.factor_sizes, 1)), axis=-1)
+            n_dist = np.sum(np.abs((anchor_factors - negative_factors) / np.subtract(self.data.factor_sizes, 1)), axis=-1)
         elif self._swap_metric == 'euclidean':
-            p_dist = np.linalg.norm(anchor_factors - positive_factors)
-            n_dist = np.linalg.norm(anchor_factors - negative_factors)
+            p_dist = np.linalg.norm(anchor_factors - positive_factors, axis=-1)
+            n_dist = np.linalg.norm(anchor_factors - negative_factors, axis=-1)
         elif self._swap_metric == 'euclidean_norm':
-            p_dist = np.linalg.norm((anchor_factors - positive_factors) / np.subtract(self.data.factor_sizes, 1))
-            n_dist = np.linalg.norm((anchor_factors - negative_factors) / np.subtract(self.data.factor_sizes, 1))
+            p_dist = np.linalg.norm((anchor_factors - positive_factors) / np.subtract(self.data.factor_sizes, 1), axis=-1)
+            n_dist = np.linalg.norm((anchor_factors - negative_factors) / np.subtract(self.data.factor_sizes, 1), axis=-1)
         else:
             raise KeyError
         # perform swap
-        if n_dist < p_dist:
-            positive_factors, negative_factors = negative_factors, positive_factors
-            # log.warning(f'Swapped factors based on metric: {self._swap_metric}')
+        swap = (n_dist < p_dist)[..., None]
+        positive_factors, negative_factors = np.where(swap, negative_factors, positive_factors), np.where(swap, positive_factors, negative_factors)
         # return factors
         return positive_factors, negative_factors
 
@@ -34,6 +34,7 @@ from BaseVAEs.models.disent.metrics import utils
 import numpy as np
 import scipy
 import scipy.stats
+from BaseVAEs.models.disent.util import spawn_process_pool
 
 
 log = logging.getLogger(__name__)
@@ -52,6 +53,7 @@ def metric_dci(
         batch_size: int = 16,
         boost_mode='sklearn',
         show_progress=False,
+        num_workers: int = 0,
 ):
     """Computes the DCI scores according to Sec 2.
     Args:
@@ -61,8 +63,10 @@ def metric_dci(
       num_train: Number of points used for training.
       num_test: Number of points used for testing.
       batch_size: Batch size for sampling.
-      boost_mode: which boosting algorithm should be used [sklearn, xgboost, lightgbm] (this can have a significant effect on score)
+      boost_mode: which boosting algorithm should be used [sklearn, xgboost, lightgbm] (this can have a significant effect on score),
+        or 'linear' for a fast logistic regression on the standardised codes, eg. for quick checks during training
       show_progress: If a tqdm progress bar should be shown
+      num_workers: If > 0, the per factor models are fitted concurrently in a process pool of this size.
     Returns:
       Dictionary with average disentanglement score, completeness and
         informativeness (train and test).
@@ -76,50 +80,101 @@ def metric_dci(
     mus_test, ys_test = utils.generate_batch_factor_code(ground_truth_dataset, representation_function, num_test, batch_size, show_progress=False)
 
     log.debug("Computing DCI metric.")
-    scores = _compute_dci(mus_train, ys_train, mus_test, ys_test, boost_mode=boost_mode, show_progress=show_progress)
+    scores = _compute_dci(mus_train, ys_train, mus_test, ys_test, boost_mode=boost_mode, show_progress=show_progress, num_workers=num_workers)
 
     return scores
 
 
-def _compute_dci(mus_train, ys_train, mus_test, ys_test, boost_mode='sklearn', show_progress=False):
+def _compute_dci(mus_train, ys_train, mus_test, ys_test, boost_mode='sklearn', show_progress=False, num_workers=0):
     """Computes score based on both training and testing codes and factors."""
-    importance_matrix, train_err, test_err = _compute_importance_gbt(mus_train, ys_train, mus_test, ys_test, boost_mode=boost_mode, show_progress=show_progress)
-    assert importance_matrix.shape[0] == mus_train.shape[0]
-    assert importance_matrix.shape[1] == ys_train.shape[0]
-    return {
-        "dci.informativeness_train": train_err,
-        "dci.informativeness_test": test_err,
-        "dci.disentanglement": _disentanglement(importance_matrix),
-        "dci.completeness": _completeness(importance_matrix),
-    }
-
-
-def _compute_importance_gbt(x_train, y_train, x_test, y_test, boost_mode='sklearn', show_progress=False):
+    fitted = fit_dci(mus_train, ys_train, boost_mode=boost_mode, show_progress=show_progress, num_workers=num_workers)
+    assert fitted.importance_matrix.shape[0] == mus_train.shape[0]
+    assert fitted.importance_matrix.shape[1] == ys_train.shape[0]
+    return fitted.score(mus_test, ys_test)
+
+
+class FittedDci(object):
+    """
+    The per factor models and importance matrix of DCI fitted on the training codes.
+    Can be kept (or pickled) to score new test codes without fitting again.
+    """
+
+    def __init__(self, models, importance_matrix, train_accuracy):
+        self.models = models
+        self.importance_matrix = importance_matrix
+        self.train_accuracy = train_accuracy
+
+    def score(self, mus_test, ys_test):
+        """Computes the scores of the test codes, only the models are evaluated, they are not fitted again."""
+        test_accuracy = np.mean([np.mean(model.predict(mus_test.T) == ys_test[i, :]) for i, model in enumerate(self.models)])
+        return {
+            "dci.informativeness_train": self.train_accuracy,
+            "dci.informativeness_test": test_accuracy,
+            "dci.disentanglement": _disentanglement(self.importance_matrix),
+            "dci.completeness": _completeness(self.importance_matrix),
+        }
+
+
+def fit_dci(mus_train, ys_train, boost_mode='sklearn', show_progress=False, num_workers=0) -> FittedDci:
+    """
+    Fit one model per factor on the training codes, concurrently in a process pool if num_workers > 0.
+    Args:
+      mus_train: codes (num_codes, num_train)-np array.
+      ys_train: factors (num_factors, num_train)-np array.
+      boost_mode: see metric_dci
+      show_progress: If a tqdm progress bar should be shown
+      num_workers: size of the process pool, models are fitted one after another if 0.
+    """
+    num_factors = ys_train.shape[0]
+    # the models are seeded from the global rng here, so that fitting in a pool gives the same models as fitting in order
+    seeds = np.random.randint(2**31, size=num_factors)
+    if num_workers > 0:
+        with spawn_process_pool(num_workers) as executor:
+            futures = [executor.submit(_fit_factor, mus_train, ys_train[i, :], boost_mode, seeds[i]) for i in range(num_factors)]
+            results = [future.result() for future in tqdm(futures, disable=(not show_progress))]
+    else:
+        results = [_fit_factor(mus_train, ys_train[i, :], boost_mode, seeds[i]) for i in tqdm(range(num_factors), disable=(not show_progress))]
+    models, importances, train_accuracies = zip(*results)
+    importance_matrix = np.stack(importances, axis=1).astype(np.float64)
+    return FittedDci(list(models), importance_matrix, np.mean(train_accuracies))
+
+
+def _make_model(boost_mode, seed=None):
+    if boost_mode == 'sklearn':
+        from sklearn.ensemble import GradientBoostingClassifier
+        return GradientBoostingClassifier(random_state=seed)
+    elif boost_mode == 'xgboost':
+        from xgboost import XGBClassifier
+        return XGBClassifier(random_state=seed)
+    elif boost_mode == 'lightgbm':
+        from lightgbm import LGBMClassifier
+        return LGBMClassifier(random_state=seed)
+    elif boost_mode == 'linear':
+        from sklearn.linear_model import LogisticRegression
+        from sklearn.pipeline import make_pipeline
+        from sklearn.preprocessing import StandardScaler
+        return make_pipeline(StandardScaler(), LogisticRegression(max_iter=1000, random_state=seed))
+    else:
+        raise KeyError(f'Invalid boosting mode: {boost_mode=}')
+
+
+def _fit_factor(x_train, y_train, boost_mode, seed=None):
+    """Fit the model of a single factor, returns the model, the importance of each code and the train accuracy."""
+    model = _make_model(boost_mode, seed=seed)
+    model.fit(x_train.T, y_train)
+    if boost_mode == 'linear':
+        # weights of the standardised codes, averaged over the classes
+        importances = np.abs(model[-1].coef_).mean(axis=0)
+    else:
+        importances = np.abs(model.feature_importances_)
+    return model, importances, np.mean(model.predict(x_train.T) == y_train)
+
+
+def _compute_importance_gbt(x_train, y_train, x_test, y_test, boost_mode='sklearn', show_progress=False, num_workers=0):
     """Compute importance based on gradient boosted trees."""
-    num_factors = y_train.shape[0]
-    num_codes = x_train.shape[0]
-    importance_matrix = np.zeros(shape=[num_codes, num_factors], dtype=np.float64)
-    train_loss = []
-    test_loss = []
-    for i in tqdm(range(num_factors), disable=(not show_progress)):
-        if boost_mode == 'sklearn':
-            from sklearn.ensemble import GradientBoostingClassifier
-            model = GradientBoostingClassifier()
-        elif boost_mode == 'xgboost':
-            from xgboost import XGBClassifier
-            model = XGBClassifier()
-        elif boost_mode == 'lightgbm':
-            from lightgbm import LGBMClassifier
-            model = LGBMClassifier()
-        else:
-            raise KeyError(f'Invalid boosting mode: {boost_mode=}')
-
-        model.fit(x_train.T, y_train[i, :])
-        importance_matrix[:, i] = np.abs(model.feature_importances_)
-        train_loss.append(np.mean(model.predict(x_train.T) == y_train[i, :]))
-        test_loss.append(np.mean(model.predict(x_test.T) == y_test[i, :]))
-
-    return importance_matrix, np.mean(train_loss), np.mean(test_loss)
+    fitted = fit_dci(x_train, y_train, boost_mode=boost_mode, show_progress=show_progress, num_workers=num_workers)
+    test_accuracy = fitted.score(x_test, y_test)["dci.informativeness_test"]
+    return fitted.importance_matrix, fitted.train_accuracy, test_accuracy
 
 
 def _disentanglement_per_code(importance_matrix):
@@ -26,12 +26,13 @@ Based on "Disentangling by Factorising" (https://arxiv.org/abs/1802.05983).
 """
 
 import logging
+from collections import deque
 from tqdm import tqdm
 
 from BaseVAEs.models.disent.dataset.groundtruth import GroundTruthDataset
 from BaseVAEs.models.disent.metrics import utils
 import numpy as np
-from BaseVAEs.models.disent.util import to_numpy
+from BaseVAEs.models.disent.util import spawn_process_pool, to_numpy
 
 
 log = logging.getLogger(__name__)
@@ -50,6 +51,8 @@ def metric_factor_vae(
         num_eval: int = 5000,
         num_variance_estimate: int = 10000,
         show_progress=False,
+        encode_batch_size: int = 1024,
+        num_workers: int = 0,
 ):
     """
     Computes the FactorVAE disentanglement metric.
@@ -91,6 +94,10 @@ def metric_factor_vae(
       num_eval: Number of points used for evaluation.
       num_variance_estimate: Number of points used to estimate global variances.
       show_progress: If a tqdm progress bar should be shown
+      encode_batch_size: Number of observations encoded at once, training samples are grouped
+        into batches of encode_batch_size // batch_size samples.
+      num_workers: If > 0, observations are built in a process pool of this size, while the
+        previous batch is encoded. The dataset must be picklable.
     Returns:
       Dictionary with scores:
         train_accuracy: Accuracy on training set.
@@ -109,7 +116,7 @@ def metric_factor_vae(
         }
 
     log.debug("Generating training set.")
-    training_votes = _generate_training_batch(ground_truth_dataset, representation_function, batch_size, num_train, global_variances, active_dims, show_progress=show_progress)
+    training_votes = _generate_training_batch(ground_truth_dataset, representation_function, batch_size, num_train, global_variances, active_dims, show_progress=show_progress, encode_batch_size=encode_batch_size, num_workers=num_workers)
     classifier = np.argmax(training_votes, axis=0)
     other_index = np.arange(training_votes.shape[1])
 
@@ -117,7 +124,7 @@ def metric_factor_vae(
     train_accuracy = np.sum(training_votes[classifier, other_index]) * 1. / np.sum(training_votes)
 
     log.debug("Generating evaluation set.")
-    eval_votes = _generate_training_batch(ground_truth_dataset, representation_function, batch_size, num_eval, global_variances, active_dims, show_progress=show_progress)
+    eval_votes = _generate_training_batch(ground_truth_dataset, representation_function, batch_size, num_eval, global_variances, active_dims, show_progress=show_progress, encode_batch_size=encode_batch_size, num_workers=num_workers)
 
     # Evaluate evaluation set accuracy
     eval_accuracy = np.sum(eval_votes[classifier, other_index]) * 1. / np.sum(eval_votes)
@@ -151,44 +158,55 @@ def _compute_variances(
       Vector with the variance of each dimension.
     """
     observations = ground_truth_dataset.dataset_sample_batch(batch_size, mode='input')
-    observations = observations.cuda()
     representations = to_numpy(utils.obtain_representation(observations, representation_function, eval_batch_size))
     representations = np.transpose(representations)
     assert representations.shape[0] == batch_size
     return np.var(representations, axis=0, ddof=1)
 
 
-def _generate_training_sample(
-        ground_truth_dataset: GroundTruthDataset,
-        representation_function: callable,
-        batch_size: int,
-        global_variances: np.ndarray,
-        active_dims: list,
-) -> (int, int):
-    """Sample a single training sample based on a mini-batch of ground-truth data.
-    Args:
-      ground_truth_dataset: GroundTruthData to be sampled from.
-      representation_function: Function that takes observation as input and
-        outputs a representation.
-      batch_size: Number of points to be used to compute the training_sample.
-      global_variances: Numpy vector with variances for all dimensions of representation.
-      active_dims: Indexes of active dimensions.
+def _sample_fixed_factor_groups(ground_truth_dataset, num_groups: int, batch_size: int):
+    """
+    Sample the factors of many training samples at once.
     Returns:
-      factor_index: Index of factor coordinate to be used.
-      argmin: Index of representation coordinate with the least variance.
+      factor_indices: (num_groups,) index of the factor that is fixed within each group.
+      factors: (num_groups, batch_size, num_factors) factors, with the fixed factor of each group shared across the group.
     """
-    # Select random coordinate to keep fixed.
-    factor_index = np.random.randint(ground_truth_dataset.num_factors)
-    # Sample two mini batches of latent variables.
-    factors = ground_truth_dataset.sample_factors(batch_size)
-    # Fix the selected factor across mini-batch.
-    factors[:, factor_index] = factors[0, factor_index]
-    # Obtain the observations.
-    observations = ground_truth_dataset.dataset_batch_from_factors(factors, mode='input').cuda()
-    representations = to_numpy(representation_function(observations))
-    local_variances = np.var(representations, axis=0, ddof=1)
-    argmin = np.argmin(local_variances[active_dims] / global_variances[active_dims])
-    return factor_index, argmin
+    # Select random coordinates to keep fixed.
+    factor_indices = np.random.randint(ground_truth_dataset.num_factors, size=num_groups)
+    # Sample mini batches of latent variables.
+    factors = ground_truth_dataset.sample_factors((num_groups, batch_size))
+    # Fix the selected factor across each mini-batch.
+    groups = np.arange(num_groups)
+    factors[groups, :, factor_indices] = factors[groups, 0, factor_indices][:, None]
+    return factor_indices, factors
+
+
+_WORKER_DATASET = None
+
+
+def _init_worker(ground_truth_dataset):
+    global _WORKER_DATASET
+    _WORKER_DATASET = ground_truth_dataset
+
+
+def _worker_batch_from_factors(factors):
+    return _WORKER_DATASET.dataset_batch_from_factors(factors, mode='input')
+
+
+def _bounded_map(executor, fn, iterable, max_pending: int):
+    """
+    Like executor.map, but only keeps max_pending submitted futures at a time,
+    the next item is submitted once a result has been consumed. executor.map
+    submits everything up front and can hold all of the results in memory.
+    """
+    iterator = iter(iterable)
+    pending = deque(executor.submit(fn, item) for _, item in zip(range(max_pending), iterator))
+    while pending:
+        result = pending.popleft().result()
+        for item in iterator:
+            pending.append(executor.submit(fn, item))
+            break
+        yield result
 
 
 def _generate_training_batch(
@@ -199,8 +217,12 @@ def _generate_training_batch(
         global_variances: np.ndarray,
         active_dims: list,
         show_progress=False,
+        encode_batch_size: int = 1024,
+        num_workers: int = 0,
 ):
     """Sample a set of training samples based on a batch of ground-truth data.
+    Many training samples are built and encoded as one batch, their local variances
+    are computed with a single reduction over each group and the votes are added in bulk.
     Args:
       ground_truth_dataset: GroundTruthData to be sampled from.
       representation_function: Function that takes observations as input and outputs a dim_representation sized representation for each observation.
@@ -208,13 +230,37 @@ def _generate_training_batch(
       num_points: Number of points to be sampled for training set.
       global_variances: Numpy vector with variances for all dimensions of representation.
       active_dims: Indexes of active dimensions.
+      show_progress: If a tqdm progress bar should be shown
+      encode_batch_size: Number of observations encoded at once.
+      num_workers: If > 0, observations are built in a process pool of this size.
     Returns:
       (num_factors, dim_representation)-sized numpy array with votes.
     """
-    votes = np.zeros((ground_truth_dataset.num_factors, global_variances.shape[0]), dtype=np.int64)
-    for _ in tqdm(range(num_points), disable=(not show_progress)):
-        factor_index, argmin = _generate_training_sample(ground_truth_dataset, representation_function, batch_size, global_variances, active_dims)
-        votes[factor_index, argmin] += 1
+    groups_per_batch = max(1, encode_batch_size // batch_size)
+    num_factors = ground_truth_dataset.num_factors
+    # sample all the factors up front, so that the results do not depend on the number of workers
+    chunks = [_sample_fixed_factor_groups(ground_truth_dataset, min(groups_per_batch, num_points - i), batch_size) for i in range(0, num_points, groups_per_batch)]
+    # observations are built lazily, or ahead of time in the process pool
+    if num_workers > 0:
+        executor = spawn_process_pool(num_workers, initializer=_init_worker, initargs=(ground_truth_dataset,))
+        observation_batches = _bounded_map(executor, _worker_batch_from_factors, (factors.reshape(-1, num_factors) for _, factors in chunks), num_workers + 1)
+    else:
+        executor = None
+        observation_batches = (ground_truth_dataset.dataset_batch_from_factors(factors.reshape(-1, num_factors), mode='input') for _, factors in chunks)
+    # encode and vote
+    votes = np.zeros((num_factors, global_variances.shape[0]), dtype=np.int64)
+    try:
+        with tqdm(total=num_points, disable=(not show_progress)) as progress:
+            for (factor_indices, factors), observations in zip(chunks, observation_batches):
+                num_groups = len(factor_indices)
+                representations = to_numpy(representation_function(observations)).reshape(num_groups, batch_size, -1)
+                local_variances = np.var(representations, axis=1, ddof=1)
+                argmins = np.argmin(local_variances[:, active_dims] / global_variances[active_dims], axis=1)
+                np.add.at(votes, (factor_indices, argmins), 1)
+                progress.update(num_groups)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
     return votes
 
 # ========================================================================= #
@@ -179,38 +179,31 @@ def aggregate_measure_distances_along_factor(
     factor_size = ground_truth_dataset.factor_sizes[f_idx]
     # -~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~- #
     # FEED FORWARD, COMPUTE ALL DELTAS & WIDTHS:
-    # TODO: repeats don't make use of the full allowed batch size effectively
-    #       if a factors dimensions are too small, then the remaining space is not used.
+    # the traversals of all repeats are packed into full batches
     # -~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~- #
-    # repeatedly take measurements along a factor, and return all the results
+    # generate repeated factors, varying one factor over a range
+    # shape: (repeats, f_sizes[i], z_size)
+    repeated_zs = encode_all_along_factor_repeats(
+        ground_truth_dataset,
+        representation_function,
+        f_idx=f_idx,
+        repeats=repeats,
+        batch_size=batch_size,
+    )
     # shapes: p -> (repeats, f_sizes[i]) & (repeats,)
-    map_p_repeats = {p: FactorRepeats([], []) for p in ps}
-    # repeat the calculations multiple times
-    for _ in range(repeats):
-        # generate repeated factors, varying one factor over a range
-        sequential_zs = encode_all_along_factor(
-            ground_truth_dataset,
-            representation_function,
-            f_idx=f_idx,
-            batch_size=batch_size,
-        )
-        # for each distance measure compute everything
-        for p in ps:
+    map_p_repeats = {}
+    for p in ps:
+        map_p_repeats[p] = FactorRepeats(
             # calculating the distances of their representations to the next values.
-            deltas = measure_next_distances_along_encodings(sequential_zs, p=p)
+            deltas=measure_next_distances_along_encodings(repeated_zs, p=p),
             # calculate the distance between the furthest two points
-            width = knn(x=sequential_zs, y=sequential_zs, k=1, largest=True, p=p).values.max()
-            # append everyhing
-            map_p_repeats[p].deltas.append(deltas)
-            map_p_repeats[p].width.append(width)
+            width=max_distances_along_encodings(repeated_zs, p=p),
+        )
     # -~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~- #
     # AGGREGATE DATA
     # -~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~- #
     aggregates = {}
     for p, repeated in map_p_repeats.items():
-        # convert everything to tensors
-        repeated.deltas = torch.stack(repeated.deltas, dim=0)  # shape (repeats, f_sizes[i])
-        repeated.width = torch.stack(repeated.width, dim=0)    # shape (repeats,)
         # check sizes
         assert repeated.deltas.shape == (repeats, factor_size)
         assert repeated.width.shape == (repeats,)
@@ -253,6 +246,17 @@ def encode_all_along_factor(ground_truth_dataset, representation_function, f_idx
     return sequential_zs
 
 
+def encode_all_along_factor_repeats(ground_truth_dataset, representation_function, f_idx: int, repeats: int, batch_size: int):
+    f_size = ground_truth_dataset.factor_sizes[f_idx]
+    # generate the traversals of all repeats (repeats, f_size, f_dims), each from a randomly sampled list of factors
+    factors = ground_truth_dataset.sample_factors(size=repeats)
+    factors = factors[:, None, :].repeat(f_size, axis=1)
+    factors[:, :, f_idx] = np.arange(f_size)
+    # get the representations of all the factors in full batches (repeats, f_size, z_size)
+    zs = encode_all_factors(ground_truth_dataset, representation_function, factors=factors.reshape(repeats * f_size, -1), batch_size=batch_size)
+    return zs.reshape(repeats, f_size, -1)
+
+
 def range_along_repeated_factors(ground_truth_dataset, idx: int, num: int) -> np.ndarray:
     """
     Aka. a traversal along a single factor
@@ -282,7 +286,25 @@ def encode_all_factors(ground_truth_dataset, representation_function, factors, b
 
 def measure_next_distances_along_encodings(sequential_zs, p='fro'):
     # find the distances to the next factors: z[i] - z[i+1]  (with wraparound)
-    return torch.norm(sequential_zs - torch.roll(sequential_zs, -1, dims=0), dim=-1, p=p)
+    # sequential_zs is (f_size, z_size) or batched (repeats, f_size, z_size)
+    return torch.norm(sequential_zs - torch.roll(sequential_zs, -1, dims=-2), dim=-1, p=p)
+
+
+def max_distances_along_encodings(repeated_zs, p='fro', max_chunk_size=2**24):
+    """
+    Distance between the furthest two points of each traversal,
+    batched version of knn(x=zs, y=zs, k=1, largest=True, p=p).values.max()
+    """
+    # check input vectors, must be a batch of arrays of vectors (repeats, f_size, z_size)
+    assert 3 == repeated_zs.ndim
+    repeats, f_size, z_size = repeated_zs.shape
+    # compute distances between each and every pair, in chunks of repeats to bound the memory used
+    chunk = max(1, max_chunk_size // (f_size * f_size * z_size))
+    widths = []
+    for zs in torch.split(repeated_zs, chunk, dim=0):
+        dist_mat = torch.norm(zs[:, :, None, ...] - zs[:, None, :, ...], dim=-1, p=p)
+        widths.append(dist_mat.flatten(start_dim=1).max(dim=-1).values)
+    return torch.cat(widths, dim=0)
 
 
 def knn(x, y, k: int = None, largest=False, p='fro'):
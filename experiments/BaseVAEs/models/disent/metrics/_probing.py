@@ -0,0 +1,77 @@
+"""
+Probing Scores
+- accuracy of simple classifiers that predict each ground truth
+  factor from the representation, like the linear probing analysis
+  in analysis_scripts/scripts_linear_probing_code_variance
+"""
+
+import logging
+import numpy as np
+from sklearn.linear_model import LogisticRegression
+from sklearn.tree import DecisionTreeClassifier
+from BaseVAEs.models.disent.metrics import utils
+
+
+log = logging.getLogger(__name__)
+
+
+# ========================================================================= #
+# Probing Scores                                                            #
+# ========================================================================= #
+
+
+def metric_probing(
+        ground_truth_data,
+        representation_function,
+        num_train=10000,
+        num_test=5000,
+        batch_size=16,
+        linear_c=0.316,
+        tree_max_depth=8,
+):
+    """Computes the test accuracy of linear and decision tree probes of each factor.
+    Args:
+      ground_truth_data: GroundTruthData to be sampled from.
+      representation_function: Function that takes observations as input and
+        outputs a dim_representation sized representation for each observation.
+      num_train: Number of points used for training.
+      num_test: Number of points used for testing.
+      batch_size: Batch size for sampling.
+      linear_c: Inverse regularization strength of the logistic regression probes.
+      tree_max_depth: Maximum depth of the decision tree probes.
+    Returns:
+      Dictionary with the probe accuracies averaged over the factors.
+    """
+    log.debug("Generating training set.")
+    mus_train, ys_train = utils.generate_batch_factor_code(ground_truth_data, representation_function, num_train, batch_size)
+    mus_test, ys_test = utils.generate_batch_factor_code(ground_truth_data, representation_function, num_test, batch_size)
+    log.debug("Fitting probes.")
+    linear_accuracy, tree_accuracy = _compute_probe_accuracies(mus_train, ys_train, mus_test, ys_test, linear_c, tree_max_depth)
+    return {
+        "probing.linear_accuracy": np.mean(linear_accuracy),
+        "probing.tree_accuracy": np.mean(tree_accuracy),
+    }
+
+
+def _compute_probe_accuracies(mus_train, ys_train, mus_test, ys_test, linear_c, tree_max_depth):
+    """Test accuracy of one logistic regression and one decision tree per factor."""
+    num_factors = ys_train.shape[0]
+    linear_accuracy = np.zeros(num_factors)
+    tree_accuracy = np.zeros(num_factors)
+    for i in range(num_factors):
+        # a factor that is constant in the training set is trivially predicted
+        if len(np.unique(ys_train[i, :])) < 2:
+            linear_accuracy[i] = tree_accuracy[i] = np.mean(ys_test[i, :] == ys_train[i, 0])
+            continue
+        linear = LogisticRegression(C=linear_c, max_iter=1000, random_state=0)
+        linear.fit(mus_train.T, ys_train[i, :])
+        linear_accuracy[i] = np.mean(linear.predict(mus_test.T) == ys_test[i, :])
+        tree = DecisionTreeClassifier(max_depth=tree_max_depth, random_state=21)
+        tree.fit(mus_train.T, ys_train[i, :])
+        tree_accuracy[i] = np.mean(tree.predict(mus_test.T) == ys_test[i, :])
+    return linear_accuracy, tree_accuracy
+
+
+# ========================================================================= #
+# END                                                                       #
+# ========================================================================= #
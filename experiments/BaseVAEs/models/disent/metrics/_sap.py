@@ -46,7 +46,8 @@ def metric_sap(
         num_train=10000,
         num_test=5000,
         batch_size=16,
-        continuous_factors=False
+        continuous_factors=False,
+        use_svm=False,
 ):
     """Computes the SAP score.
     Args:
@@ -57,6 +58,8 @@ def metric_sap(
       num_test: Number of points used for testing discrete variables.
       batch_size: Batch size for sampling.
       continuous_factors: Factors are continuous variable (True) or not (False).
+      use_svm: Score discrete factors with a LinearSVC per (latent, factor) pair as in the
+        reference implementation (True) or with the closed form 1-D classifier (False).
     Returns:
       Dictionary with SAP score.
     """
@@ -64,12 +67,12 @@ def metric_sap(
     mus, ys = utils.generate_batch_factor_code(ground_truth_data, representation_function, num_train, batch_size)
     mus_test, ys_test = utils.generate_batch_factor_code(ground_truth_data, representation_function, num_test, batch_size)
     log.debug("Computing score matrix.")
-    return _compute_sap(mus, ys, mus_test, ys_test, continuous_factors)
+    return _compute_sap(mus, ys, mus_test, ys_test, continuous_factors, use_svm=use_svm)
 
 
-def _compute_sap(mus, ys, mus_test, ys_test, continuous_factors):
+def _compute_sap(mus, ys, mus_test, ys_test, continuous_factors, use_svm=False):
     """Computes score based on both training and testing codes and factors."""
-    score_matrix = _compute_score_matrix(mus, ys, mus_test, ys_test, continuous_factors)
+    score_matrix = _compute_score_matrix(mus, ys, mus_test, ys_test, continuous_factors, use_svm=use_svm)
     # Score matrix should have shape [num_latents, num_factors].
     assert score_matrix.shape[0] == mus.shape[0]
     assert score_matrix.shape[1] == ys.shape[0]
@@ -81,8 +84,61 @@ def _compute_sap(mus, ys, mus_test, ys_test, continuous_factors):
     }
 
 
-def _compute_score_matrix(mus, ys, mus_test, ys_test, continuous_factors):
+def _compute_score_matrix(mus, ys, mus_test, ys_test, continuous_factors, use_svm=False):
     """Compute score matrix as described in Section 3."""
+    if continuous_factors:
+        # Attribute is considered continuous.
+        return _compute_continuous_score_matrix(mus, ys)
+    elif use_svm:
+        # Attribute is considered discrete.
+        return _compute_svm_score_matrix(mus, ys, mus_test, ys_test)
+    else:
+        # Attribute is considered discrete.
+        return _compute_threshold_score_matrix(mus, ys, mus_test, ys_test)
+
+
+def _compute_continuous_score_matrix(mus, ys):
+    """Squared correlations of all (latent, factor) pairs, zero for constant latents."""
+    mus_centered = mus - mus.mean(axis=1, keepdims=True)
+    ys_centered = ys - ys.mean(axis=1, keepdims=True)
+    num_points = mus.shape[1]
+    cov_mu_y = (mus_centered @ ys_centered.T / (num_points - 1)) ** 2
+    var_mu = np.sum(mus_centered ** 2, axis=1) / (num_points - 1)
+    var_y = np.sum(ys_centered ** 2, axis=1) / (num_points - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        score_matrix = cov_mu_y / (var_mu[:, None] * var_y[None, :])
+    return np.where(var_mu[:, None] > 1e-12, score_matrix, 0.)
+
+
+def _compute_threshold_score_matrix(mus, ys, mus_test, ys_test):
+    """
+    Test accuracy of a 1-D classifier for each (latent, factor) pair. Like a linear
+    classifier on a single latent, it splits the latent into one interval per class,
+    with the thresholds at the midpoints between the sorted class means. The class means
+    of all latents are computed at once, classification of all latents is a single sort
+    and comparison per factor.
+    """
+    num_latents = mus.shape[0]
+    num_factors = ys.shape[0]
+    score_matrix = np.zeros([num_latents, num_factors])
+    for j in range(num_factors):
+        classes, y_train = np.unique(ys[j, :], return_inverse=True)
+        # class means of all the latents [num_latents, num_classes]
+        one_hot = np.eye(len(classes))[y_train]
+        class_means = (mus @ one_hot) / one_hot.sum(axis=0)
+        # intervals of each class along each latent
+        order = np.argsort(class_means, axis=1)
+        sorted_means = np.take_along_axis(class_means, order, axis=1)
+        thresholds = (sorted_means[:, 1:] + sorted_means[:, :-1]) / 2
+        # classify the test set, the number of thresholds below a point gives the interval
+        intervals = np.sum(mus_test[:, :, None] > thresholds[:, None, :], axis=2)
+        pred = classes[np.take_along_axis(order, intervals, axis=1)]
+        score_matrix[:, j] = np.mean(pred == ys_test[j, None, :], axis=1)
+    return score_matrix
+
+
+def _compute_svm_score_matrix(mus, ys, mus_test, ys_test):
+    """Reference version, fits a LinearSVC for each (latent, factor) pair."""
     num_latents = mus.shape[0]
     num_factors = ys.shape[0]
     score_matrix = np.zeros([num_latents, num_factors])
@@ -90,24 +146,12 @@ def _compute_score_matrix(mus, ys, mus_test, ys_test, continuous_factors):
         for j in range(num_factors):
             mu_i = mus[i, :]
             y_j = ys[j, :]
-            if continuous_factors:
-                # Attribute is considered continuous.
-                cov_mu_i_y_j = np.cov(mu_i, y_j, ddof=1)
-                cov_mu_y = cov_mu_i_y_j[0, 1] ** 2
-                var_mu = cov_mu_i_y_j[0, 0]
-                var_y = cov_mu_i_y_j[1, 1]
-                if var_mu > 1e-12:
-                    score_matrix[i, j] = cov_mu_y * 1. / (var_mu * var_y)
-                else:
-                    score_matrix[i, j] = 0.
-            else:
-                # Attribute is considered discrete.
-                mu_i_test = mus_test[i, :]
-                y_j_test = ys_test[j, :]
-                classifier = svm.LinearSVC(C=0.01, class_weight="balanced")
-                classifier.fit(mu_i[:, np.newaxis], y_j)
-                pred = classifier.predict(mu_i_test[:, np.newaxis])
-                score_matrix[i, j] = np.mean(pred == y_j_test)
+            mu_i_test = mus_test[i, :]
+            y_j_test = ys_test[j, :]
+            classifier = svm.LinearSVC(C=0.01, class_weight="balanced")
+            classifier.fit(mu_i[:, np.newaxis], y_j)
+            pred = classifier.predict(mu_i_test[:, np.newaxis])
+            score_matrix[i, j] = np.mean(pred == y_j_test)
     return score_matrix
 
 
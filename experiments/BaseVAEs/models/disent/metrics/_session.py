@@ -0,0 +1,214 @@
+"""
+Evaluation Session
+- encodes the ground truth factor space once and serves
+  the representations of all the metrics from a shared cache.
+"""
+
+import logging
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+import torch
+from numpy.lib.format import open_memmap
+from torch.utils.data.dataloader import default_collate
+from tqdm import tqdm
+
+from BaseVAEs.models.disent.data.util.state_space import StateSpace
+from BaseVAEs.models.disent.dataset.groundtruth import GroundTruthDataset
+from BaseVAEs.models.disent.util import TempNumpySeed, chunked, to_numpy
+
+
+log = logging.getLogger(__name__)
+
+
+# ========================================================================= #
+# evaluation session                                                        #
+# ========================================================================= #
+
+
+class EvaluationSession(object):
+    """
+    Encodes the observations of a ground truth dataset at most once and serves
+    all the metrics from the cached codes, so that evaluating a checkpoint
+    costs a single encoder pass over the data instead of one per metric.
+
+    The codes of the whole factor space are stored in one array indexed by the
+    state space index of the factors. Codes are computed lazily the first time
+    they are requested, or up front with encode(). If cache_dir is given, the
+    array is memory mapped to "{cache_dir}/{checkpoint_hash}.codes.npy" with
+    a mask of the encoded indices beside it, so that the cache is reused by
+    later evaluations of the same checkpoint.
+
+    If num_points is given, the metrics only sample from a fixed random subset
+    of the factor space of that size. Metrics that construct their own factors,
+    eg. factor_vae and flatness, still encode missing points on demand.
+
+    Usage:
+        session = EvaluationSession(dataset, representation_function, checkpoint_hash=file_hash(path), cache_dir='cache')
+        session.encode()
+        results = session.evaluate(FAST_METRICS)
+    """
+
+    def __init__(
+            self,
+            ground_truth_dataset: GroundTruthDataset,
+            representation_function: callable,
+            checkpoint_hash: Optional[str] = None,
+            cache_dir: Optional[str] = None,
+            num_points: Optional[int] = None,
+            batch_size: int = 64,
+            seed: Optional[int] = 777,
+    ):
+        assert (cache_dir is None) or (checkpoint_hash is not None), 'a checkpoint_hash is required to cache the codes in cache_dir'
+        self._ground_truth_dataset = ground_truth_dataset
+        self._representation_function = representation_function
+        self._checkpoint_hash = checkpoint_hash
+        self._cache_dir = cache_dir
+        self._batch_size = batch_size
+        # fixed subset of the factor space that is sampled from
+        self._indices = None
+        if num_points is not None:
+            with TempNumpySeed(seed):
+                self._indices = np.sort(np.random.choice(len(ground_truth_dataset), size=min(num_points, len(ground_truth_dataset)), replace=False))
+        # cache, initialised on the first encoding if it does not exist yet
+        self._codes, self._encoded = None, None
+        if (cache_dir is not None) and all(os.path.exists(path) for path in self._cache_paths):
+            self._codes, self._encoded = (open_memmap(path, mode='r+') for path in self._cache_paths)
+            assert len(self._codes) == len(self._encoded) == len(ground_truth_dataset), f'cached codes do not match the dataset: {self._cache_paths}'
+            log.debug(f'loaded cached codes: {self._cache_paths[0]} ({self._encoded.sum()}/{len(self._encoded)} encoded)')
+        # metrics are served from this dataset, which returns the cached codes as observations
+        self.dataset = _CachedGroundTruthDataset(self)
+
+    @property
+    def _cache_paths(self) -> Tuple[str, str]:
+        return (
+            os.path.join(self._cache_dir, f'{self._checkpoint_hash}.codes.npy'),
+            os.path.join(self._cache_dir, f'{self._checkpoint_hash}.encoded.npy'),
+        )
+
+    @property
+    def ground_truth_dataset(self) -> GroundTruthDataset:
+        return self._ground_truth_dataset
+
+    @property
+    def indices(self) -> Optional[np.ndarray]:
+        """The fixed subset of the factor space that is sampled from, or None for the whole factor space"""
+        return self._indices
+
+    @staticmethod
+    def representation_function(codes):
+        """The observations of the session dataset already are the representations"""
+        return codes
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    # Cache                                                                 #
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+
+    def _init_cache(self, codes: np.ndarray):
+        shape, dtype = (len(self._ground_truth_dataset), *codes.shape[1:]), codes.dtype
+        if self._cache_dir is None:
+            self._codes = np.zeros(shape, dtype=dtype)
+            self._encoded = np.zeros(shape[0], dtype=np.bool_)
+        else:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            codes_path, encoded_path = self._cache_paths
+            self._codes = open_memmap(codes_path, mode='w+', dtype=dtype, shape=shape)
+            self._encoded = open_memmap(encoded_path, mode='w+', dtype=np.bool_, shape=(shape[0],))
+
+    def _encode_missing(self, indices: np.ndarray, show_progress=False):
+        if self._encoded is not None:
+            indices = indices[~self._encoded[indices]]
+        indices = np.unique(indices)
+        if len(indices) == 0:
+            return
+        # the mask is only updated once the codes are on disk, the os may write back the dirty pages of
+        # both memory maps in any order, so marking the indices during the loop could persist the mask first
+        done = []
+        try:
+            with torch.no_grad():
+                for batch_indices in tqdm(chunked(indices, self._batch_size), total=(len(indices) + self._batch_size - 1) // self._batch_size, disable=not show_progress):
+                    batch = self._ground_truth_dataset.dataset_batch_from_indices(batch_indices, mode='input')
+                    codes = to_numpy(self._representation_function(batch))
+                    if self._codes is None:
+                        self._init_cache(codes)
+                    self._codes[batch_indices] = codes
+                    done.append(batch_indices)
+        finally:
+            if done:
+                if isinstance(self._codes, np.memmap):
+                    self._codes.flush()
+                self._encoded[np.concatenate(done)] = True
+                if isinstance(self._encoded, np.memmap):
+                    self._encoded.flush()
+
+    def encode(self, show_progress=False):
+        """Encode the whole factor space, or the fixed subset if num_points was given, in a single pass"""
+        indices = np.arange(len(self._ground_truth_dataset)) if (self._indices is None) else self._indices
+        self._encode_missing(indices, show_progress=show_progress)
+
+    def get_codes(self, indices) -> np.ndarray:
+        """Get the codes of the observations at the given state space indices, encoding missing ones"""
+        indices = np.asarray(indices)
+        self._encode_missing(indices.reshape(-1))
+        return self._codes[indices]
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+    # Metrics                                                               #
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
+
+    def evaluate(self, metrics) -> dict:
+        """
+        Compute the given metrics from the cached codes.
+        Args:
+          metrics: dict of metric functions, eg. FAST_METRICS or DEFAULT_METRICS, or a list of metric functions.
+        Returns:
+          Dictionary with the merged results of all the metrics.
+        """
+        if isinstance(metrics, dict):
+            metrics = metrics.values()
+        results = {}
+        for metric in metrics:
+            results.update(metric(self.dataset, self.representation_function))
+        return results
+
+
+class _CachedGroundTruthDataset(StateSpace):
+    """
+    Stand-in for the GroundTruthDataset passed to the metrics,
+    observations are replaced by the cached codes of the session.
+    """
+
+    def __init__(self, session: EvaluationSession):
+        super().__init__(factor_sizes=session.ground_truth_dataset.factor_sizes)
+        self._session = session
+
+    @property
+    def factor_names(self) -> Tuple[str, ...]:
+        return self._session.ground_truth_dataset.factor_names
+
+    def sample_factors(self, size=None, factor_indices=None) -> np.ndarray:
+        # only sample from the fixed subset of the session
+        if (self._session.indices is None) or (factor_indices is not None):
+            return super().sample_factors(size=size, factor_indices=factor_indices)
+        return self.idx_to_pos(np.random.choice(self._session.indices, size=size))
+
+    def dataset_batch_from_indices(self, indices, mode: str):
+        return torch.from_numpy(self._session.get_codes(indices))
+
+    def dataset_batch_from_factors(self, factors: np.ndarray, mode: str):
+        return self.dataset_batch_from_indices(self.pos_to_idx(factors), mode=mode)
+
+    def dataset_sample_batch_with_factors(self, num_samples: int, mode: str):
+        factors = self.sample_factors(num_samples)
+        batch = self.dataset_batch_from_factors(factors, mode=mode)
+        return batch, default_collate(factors)
+
+    def dataset_sample_batch(self, num_samples: int, mode: str):
+        factors = self.sample_factors(num_samples)
+        return self.dataset_batch_from_factors(factors, mode=mode)
+
+
+# ========================================================================= #
+# END                                                                       #
+# ========================================================================= #
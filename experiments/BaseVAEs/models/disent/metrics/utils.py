@@ -28,7 +28,7 @@ import sklearn
 from tqdm import tqdm
 
 from BaseVAEs.models.disent.dataset.groundtruth import GroundTruthDataset
-from BaseVAEs.models.disent.util import to_numpy
+from BaseVAEs.models.disent.util import chunked, to_numpy
 
 
 # ========================================================================= #
@@ -42,6 +42,7 @@ def generate_batch_factor_code(
         num_points,
         batch_size,
         show_progress=False,
+        memmap_dir=None,
 ):
     """Sample a single training sample based on a mini-batch of ground-truth data.
     Args:
@@ -50,6 +51,7 @@ def generate_batch_factor_code(
       num_points: Number of points to sample.
       batch_size: Batchsize to sample points.
       show_progress: if a progress bar should be shown
+      memmap_dir: if given, the outputs are memory mapped to anonymous files in this directory instead of held in memory.
     Returns:
       representations: Codes (num_codes, num_points)-np array.
       factors: Factors generating the codes (num_factors, num_points)-np array.
@@ -58,22 +60,104 @@ def generate_batch_factor_code(
     factors = None
     i = 0
     with tqdm(total=num_points, disable=not show_progress) as bar:
-        while i < num_points:
-            num_points_iter = min(num_points - i, batch_size)
-            current_observations, current_factors = ground_truth_dataset.dataset_sample_batch_with_factors(
-                num_points_iter, mode='input')
+        for current_representations, current_factors in iter_batch_factor_code(ground_truth_dataset, representation_function, num_points, batch_size):
+            # preallocate the outputs once the shapes are known
             if i == 0:
-                factors = current_factors
-                representations = to_numpy(representation_function(current_observations))
-            else:
-                factors = np.vstack((factors, current_factors))
-                representations = np.vstack(
-                    (representations, to_numpy(representation_function(current_observations))))
+                representations = _allocate((num_points, *current_representations.shape[1:]), current_representations.dtype, memmap_dir)
+                factors = _allocate((num_points, *current_factors.shape[1:]), current_factors.dtype, memmap_dir)
+            num_points_iter = len(current_representations)
+            representations[i:i + num_points_iter] = current_representations
+            factors[i:i + num_points_iter] = current_factors
             i += num_points_iter
             bar.update(num_points_iter)
     return np.transpose(representations), np.transpose(factors)
 
 
+def iter_batch_factor_code(
+        ground_truth_dataset: GroundTruthDataset,
+        representation_function,
+        num_points,
+        batch_size,
+        prefetch=True,
+):
+    """Stream codes and factors of randomly sampled ground-truth data in chunks.
+    If prefetch is set, the factors and observations of the next batch are sampled
+    in a background thread while the current batch is encoded.
+    Args:
+      ground_truth_dataset: GroundTruthData to be sampled from.
+      representation_function: Function that takes observation as input and outputs a representation.
+      num_points: Number of points to sample.
+      batch_size: Batchsize to sample points.
+      prefetch: if the next batch should be sampled in the background.
+    Yields:
+      representations: Codes (batch_size, num_codes)-np array.
+      factors: Factors generating the codes (batch_size, num_factors)-np array.
+    """
+    batch_sizes = [min(num_points - i, batch_size) for i in range(0, num_points, batch_size)]
+    batches = (ground_truth_dataset.dataset_sample_batch_with_factors(size, mode='input') for size in batch_sizes)
+    if prefetch:
+        batches = _prefetch(batches)
+    for observations, factors in batches:
+        yield to_numpy(representation_function(observations)), to_numpy(factors)
+
+
+def _allocate(shape, dtype, memmap_dir=None):
+    """Allocate an output array, memory mapped to an anonymous file in memmap_dir if given."""
+    if memmap_dir is None:
+        return np.empty(shape, dtype=dtype)
+    import os
+    import tempfile
+    from numpy.lib.format import open_memmap
+    fd, path = tempfile.mkstemp(suffix='.npy', dir=memmap_dir)
+    os.close(fd)
+    array = open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+    # the mapping stays valid after the file is removed, its space is freed with the array
+    os.remove(path)
+    return array
+
+
+def _prefetch(iterator, size=1):
+    """Consume the iterator in a background thread, keeping up to size items ready ahead of the consumer."""
+    import queue
+    import threading
+
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # give up if the consumer stopped early
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for item in iterator:
+                if not put((True, item)):
+                    return
+            put((True, done))
+        except BaseException as e:
+            put((False, e))
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        while True:
+            ok, item = items.get()
+            if not ok:
+                raise item
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+
+
 def split_train_test(observations, train_percentage):
     """
     Splits observations into a train and test set.
@@ -106,23 +190,110 @@ def obtain_representation(observations, representation_function, batch_size):
       representations: Codes (num_codes, num_points)-Numpy array.
     """
     representations = None
-    # TODO: use chunked
     num_points = observations.shape[0]
     i = 0
-    while i < num_points:
-        num_points_iter = min(num_points - i, batch_size)
-        current_observations = observations[i:i + num_points_iter]
+    for current_observations in chunked(observations, batch_size):
+        current_representations = to_numpy(representation_function(current_observations))
+        # preallocate the output once the shape is known
         if i == 0:
-            representations = to_numpy(representation_function(current_observations))
-        else:
-            representations = np.vstack((representations, to_numpy(representation_function(current_observations))))
-        i += num_points_iter
+            representations = np.empty((num_points, *current_representations.shape[1:]), dtype=current_representations.dtype)
+        representations[i:i + len(current_representations)] = current_representations
+        i += len(current_representations)
     return np.transpose(representations)
 
 
 def histogram_discretize(target, num_bins=20):
     """
     Discretization based on histograms.
+    Equivalent to digitizing each row with the bin edges of np.histogram, for all rows at once.
+    """
+    target = np.asarray(target)
+    mins, maxs = target.min(axis=1), target.max(axis=1)
+    # np.histogram expands the range of constant rows
+    const = (mins == maxs)
+    mins, maxs = np.where(const, mins - 0.5, mins), np.where(const, maxs + 0.5, maxs)
+    # bin edges like np.histogram, then the count of lower edges <= value is the digitized bin
+    edges = np.linspace(mins, maxs, num_bins + 1, endpoint=True, axis=1)
+    discretized = np.zeros_like(target)
+    for i in range(num_bins):
+        discretized += (target >= edges[:, i:i+1])
+    return discretized
+
+
+def _dense_labels(xs):
+    """
+    Relabel the values of each row to 0, 1, ..., K-1 in order of their sorted values.
+    Returns the labels and the number of distinct values K of each row.
+    """
+    order = np.argsort(xs, axis=1, kind='stable')
+    sorted_xs = np.take_along_axis(xs, order, axis=1)
+    ranks = np.zeros(xs.shape, dtype=np.int64)
+    ranks[:, 1:] = np.cumsum(sorted_xs[:, 1:] != sorted_xs[:, :-1], axis=1)
+    labels = np.empty_like(ranks)
+    np.put_along_axis(labels, order, ranks, axis=1)
+    return labels, ranks[:, -1] + 1
+
+
+def _label_counts(labels, num_labels):
+    """Counts of each label for each row, zero padded to [num_rows, num_labels]"""
+    num_rows = labels.shape[0]
+    counts = np.bincount((labels + np.arange(num_rows)[:, None] * num_labels).ravel(), minlength=num_rows * num_labels)
+    return counts.reshape(num_rows, num_labels)
+
+
+def discrete_mutual_info(mus, ys, max_chunk_size=2**25):
+    """
+    Compute discrete mutual information.
+    Builds the joint histograms of all (code, factor) pairs with a single np.bincount per chunk of codes
+    and computes the whole [num_codes, num_factors] MI matrix from them, equivalent to sklearn.metrics.mutual_info_score.
+    Args:
+      mus: discrete codes (num_codes, num_points)-np array.
+      ys: discrete factors (num_factors, num_points)-np array.
+      max_chunk_size: upper bound on the number of elements of the intermediate arrays of each chunk of codes.
+    """
+    num_codes, num_points = mus.shape
+    num_factors = ys.shape[0]
+    assert ys.shape[1] == num_points
+    mu_labels, mu_sizes = _dense_labels(np.asarray(mus))
+    y_labels, y_sizes = _dense_labels(np.asarray(ys))
+    ka, kb = int(mu_sizes.max()), int(y_sizes.max())
+    # marginal counts
+    mu_counts = _label_counts(mu_labels, ka)  # [num_codes, ka]
+    y_counts = _label_counts(y_labels, kb)    # [num_factors, kb]
+    # joint counts of chunks of codes with all the factors
+    chunk = max(1, max_chunk_size // (num_factors * max(num_points, ka * kb)))
+    m = np.zeros([num_codes, num_factors])
+    pair_offsets = np.arange(num_factors)[:, None] * (ka * kb)
+    for i in range(0, num_codes, chunk):
+        c = min(chunk, num_codes - i)
+        # [c, num_factors, num_points] index into the flattened [c, num_factors, ka, kb] joint histograms
+        keys = (np.arange(c)[:, None, None] * (num_factors * ka * kb)) + pair_offsets[None, :, :] + (mu_labels[i:i+c, None, :] * kb) + y_labels[None, :, :]
+        joint = np.bincount(keys.ravel(), minlength=c * num_factors * ka * kb).reshape(c, num_factors, ka, kb)
+        # MI = sum_ab n_ab / n * log(n * n_ab / (n_a * n_b)), over the nonzero n_ab
+        outer = mu_counts[i:i+c, None, :, None] * y_counts[None, :, None, :]
+        nonzero = joint > 0
+        terms = np.zeros(joint.shape)
+        terms[nonzero] = (joint[nonzero] / num_points) * (np.log(joint[nonzero]) + np.log(num_points) - np.log(outer[nonzero]))
+        m[i:i+c] = terms.sum(axis=(2, 3))
+    return np.clip(m, 0., None)
+
+
+def discrete_entropy(ys):
+    """
+    Compute discrete entropy, ie. the mutual information of each factor with itself.
+    """
+    y_labels, y_sizes = _dense_labels(np.asarray(ys))
+    num_points = ys.shape[1]
+    counts = _label_counts(y_labels, int(y_sizes.max()))
+    nonzero = counts > 0
+    terms = np.zeros(counts.shape)
+    terms[nonzero] = (counts[nonzero] / num_points) * (np.log(num_points) - np.log(counts[nonzero]))
+    return np.clip(terms.sum(axis=1), 0., None)
+
+
+def _histogram_discretize_loop(target, num_bins=20):
+    """
+    Reference version of histogram_discretize.
     """
     discretized = np.zeros_like(target)
     for i in range(target.shape[0]):
@@ -130,9 +301,9 @@ def histogram_discretize(target, num_bins=20):
     return discretized
 
 
-def discrete_mutual_info(mus, ys):
+def _discrete_mutual_info_sklearn(mus, ys):
     """
-    Compute discrete mutual information.
+    Reference version of discrete_mutual_info.
     """
     num_codes = mus.shape[0]
     num_factors = ys.shape[0]
@@ -143,9 +314,9 @@ def discrete_mutual_info(mus, ys):
     return m
 
 
-def discrete_entropy(ys):
+def _discrete_entropy_sklearn(ys):
     """
-    Compute discrete mutual information.
+    Reference version of discrete_entropy.
     """
     num_factors = ys.shape[0]
     h = np.zeros(num_factors)
@@ -156,3 +327,31 @@ def discrete_entropy(ys):
 # ========================================================================= #
 # END                                                                       #
 # ========================================================================= #
+
+
+if __name__ == '__main__':
+    import time
+
+    def check_and_time(name, fn, ref_fn, *args):
+        t = time.perf_counter()
+        out = fn(*args)
+        t_fast = time.perf_counter() - t
+        t = time.perf_counter()
+        ref = ref_fn(*args)
+        t_ref = time.perf_counter() - t
+        print(f'{name:>22}: max abs diff {np.max(np.abs(out - ref)):.2e} | vectorized {t_fast:8.3f}s | reference {t_ref:8.3f}s | speedup {t_ref / t_fast:7.1f}x')
+        np.testing.assert_allclose(out, ref, rtol=0, atol=1e-12, err_msg=f'{name} differs from the reference implementation')
+
+    # equivalence with the reference implementations, and speed, for mig like and unsupervised like inputs
+    np.random.seed(42)
+    for num_points in [10_000, 100_000]:
+        num_codes, factor_sizes = 64, [3, 6, 40, 32, 32]
+        print(f'{num_points} points, {num_codes} codes, factor sizes {factor_sizes}')
+        ys = np.stack([np.random.randint(0, size, num_points) for size in factor_sizes])
+        mus = np.random.randn(num_codes, num_points) + 0.5 * np.repeat(ys, (num_codes + len(ys) - 1) // len(ys), axis=0)[:num_codes]
+        mus[-1] = 1.  # constant code
+        check_and_time('histogram_discretize', histogram_discretize, _histogram_discretize_loop, mus)
+        mus_discrete = histogram_discretize(mus)
+        check_and_time('discrete_mutual_info', discrete_mutual_info, _discrete_mutual_info_sklearn, mus_discrete, ys)
+        check_and_time('unsupervised mi', discrete_mutual_info, _discrete_mutual_info_sklearn, mus_discrete, mus_discrete)
+        check_and_time('discrete_entropy', discrete_entropy, _discrete_entropy_sklearn, ys)
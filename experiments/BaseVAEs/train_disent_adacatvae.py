@@ -14,6 +14,7 @@ from torch.optim import lr_scheduler
 from torch.optim import Adam
 from disent.model.ae import EncoderConv64, DecoderConv64, AutoEncoder
 from disent.frameworks.vae.weaklysupervised import AdaCatVae
+from disent.util import AsyncCheckpointWriter
 
 import experiments.BaseVAEs.utils_disent as utils
 import experiments.BaseVAEs.data as data
@@ -27,6 +28,8 @@ def train(model, data_loader, log_samples, optimizer, scheduler, writer, config)
 
     warmup_steps = 0
 
+    ckpt_writer = AsyncCheckpointWriter(max_to_keep=config['keep_ckpts'])
+
     for e in range(0, config['epochs']):
         max_iter = len(data_loader)
         start = time.time()
@@ -102,13 +105,15 @@ def train(model, data_loader, log_samples, optimizer, scheduler, writer, config)
                 'ep': e,
                 'config': config
             }
-            torch.save(state, os.path.join(config['model_dir'], '%05d.pth' % (e)))
+            ckpt_writer.save(state, os.path.join(config['model_dir'], '%05d.pth' % (e)))
 
             # plot a few samples with proto recon
             utils.plot_examples(log_samples, model, writer, config, step=e)
 
             print(f'SAVED - epoch {e} - imgs @ {config["img_dir"]} - model @ {config["model_dir"]}')
 
+    ckpt_writer.close()
+
 
 def main(config):
 
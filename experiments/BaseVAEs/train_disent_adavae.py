@@ -14,6 +14,7 @@ from torch.optim import lr_scheduler
 from torch.optim import Adam
 from disent.model.ae import EncoderConv64, DecoderConv64, AutoEncoder
 from disent.frameworks.vae.weaklysupervised import AdaVae
+from disent.util import AsyncCheckpointWriter
 
 import experiments.BaseVAEs.utils_disent as utils
 import experiments.BaseVAEs.data as data
@@ -27,6 +28,8 @@ def train(model, data_loader, log_samples, optimizer, scheduler, writer, config)
 
     warmup_steps = 0
 
+    ckpt_writer = AsyncCheckpointWriter(max_to_keep=config['keep_ckpts'])
+
     for e in range(0, config['epochs']):
         max_iter = len(data_loader)
         start = time.time()
@@ -100,7 +103,7 @@ def train(model, data_loader, log_samples, optimizer, scheduler, writer, config)
                 'ep': e,
                 'config': config
             }
-            torch.save(state, os.path.join(config['model_dir'], '%05d.pth' % (e)))
+            ckpt_writer.save(state, os.path.join(config['model_dir'], '%05d.pth' % (e)))
 
             # plot the individual prototypes of each group
             # utils.plot_prototypes(model, writer, config, step=e)
@@ -110,6 +113,8 @@ def train(model, data_loader, log_samples, optimizer, scheduler, writer, config)
 
             print(f'SAVED - epoch {e} - imgs @ {config["img_dir"]} - model @ {config["model_dir"]}')
 
+    ckpt_writer.close()
+
 
 def main(config):
 
@@ -17,6 +17,8 @@ def _get_parser():
     # parser.add_argument('--learn', type=str, required=True, help='unsup, weakly or sup')
 
     parser.add_argument('--save-step', type=int, default=25, help='save model every # steps')
+    parser.add_argument('--keep-ckpts', type=int, default=None,
+                        help='number of most recent checkpoints to keep, older ones are deleted. Keeps all by default')
     parser.add_argument('--print-step', type=int, default=10, help='print metrics every # steps')
     parser.add_argument('--display-step', type=int, default=1,
                         help='track metrics and iamges on tensorboard every # steps')
@@ -39,6 +41,10 @@ def _get_parser():
                                                                            'have 2xbs')
     parser.add_argument('-e', '--epochs', type=int, default=500, help='Number of epochs to train for')
     parser.add_argument('--n-workers', type=int, default=0, help='workers to load data')
+    parser.add_argument('--data-storage', type=str, default='memory', choices=['memory', 'uint8', 'mmap'],
+                        help="how the image pairs are stored, 'memory': normalized float arrays, 'uint8': uint8 "
+                             "[N, 2, C, W, H] arrays cached beside the data files, scaled to float per batch, "
+                             "'mmap': memory mapped raw arrays, normalized per batch")
 
     parser.add_argument('-pv', '--prototype-vectors', type=int , nargs='+', default=[6, 6, 6],
                         help='List of number of prototype vectors per category [#p1, #p2, ...]')
@@ -58,6 +64,11 @@ def _get_parser():
     parser.add_argument('--img-dir', type=str, default='imgs', help='image/plot directory')
     parser.add_argument('-dd', '--data-dir', type=str, default='Data', help='data directory')
 
+    parser.add_argument('--debug-anomaly', action='store_true',
+                        help='should autograd anomaly detection be enabled? This records the forward pass of every op '
+                             'to locate NaN/Inf gradients, but slows down training considerably. Without it only a '
+                             'lightweight NaN/Inf check on the loss and gradients is run every step.')
+
     parser.add_argument('-s', '--seed', type=int, default=42, help='seed')
 
     parser.add_argument('-d', '--dataset', type=str, default='toycolor',
@@ -6,6 +6,9 @@ import numpy as np
 import ProtoLearning.models.modules as modules
 from ProtoLearning.models.torch_truncnorm.TruncatedNormal import TruncatedNormal
 
+# outputs of iCSN.forward that can be requested
+PAIR_OUTPUTS = ('preds', 'recons', 'recons_swap')
+
 
 class iCSN(nn.Module):
 	def __init__(self, num_hiddens, num_residual_layers, num_residual_hiddens, n_proto_vecs=[4, 2],
@@ -94,7 +97,13 @@ class iCSN(nn.Module):
 	# ------------------------------------------------------------------------------------------------ #
 	# fcts for forward passing
 
-	def forward(self, imgs, shared_masks):
+	def forward(self, imgs, shared_masks, outputs=PAIR_OUTPUTS):
+		"""
+		:param outputs: which outputs to compute, any of 'preds' (pred0, pred1), 'recons' (reconstructions of the
+		non-swapped codes) and 'recons_swap' (reconstructions of the swapped codes). Outputs that are not requested are
+		not computed and returned as None.
+		"""
+		assert set(outputs) <= set(PAIR_OUTPUTS), f'Unknown outputs {outputs}'
 		(x0, x1) = imgs # sample, negative sample
 
 		self.batch_size = x0.shape[0]
@@ -120,14 +129,20 @@ class iCSN(nn.Module):
 			pred0_swap = torch.cat((pred0_swap, z0_extra), dim=1)
 			pred1_swap = torch.cat((pred1_swap, z1_extra), dim=1)
 
-		# convert codes and extra encoding via decoder to reconstruction
-		z0_proto_recon = self.proto_decode(pred0)
-		z1_proto_recon = self.proto_decode(pred1)
-		z0_proto_recon_swap = self.proto_decode(pred0_swap)
-		z1_proto_recon_swap = self.proto_decode(pred1_swap)
+		# convert the requested codes and extra encoding via decoder to reconstruction
+		z0_proto_recon, z1_proto_recon, z0_proto_recon_swap, z1_proto_recon_swap = None, None, None, None
+		if 'recons' in outputs:
+			z0_proto_recon = self.proto_decode(pred0)
+			z1_proto_recon = self.proto_decode(pred1)
+		if 'recons_swap' in outputs:
+			z0_proto_recon_swap = self.proto_decode(pred0_swap)
+			z1_proto_recon_swap = self.proto_decode(pred1_swap)
 
 		# remove the continuous variables from the final prediction
-		if self.extra_mlp_dim != 0.:
+		if 'preds' not in outputs:
+			pred0 = None
+			pred1 = None
+		elif self.extra_mlp_dim != 0.:
 			pred0 = pred0[:, :-self.extra_mlp_dim]
 			pred1 = pred1[:, :-self.extra_mlp_dim]
 
@@ -0,0 +1,215 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+import experiments.ProtoLearning.data as data
+import experiments.ProtoLearning.utils as utils
+from experiments.ProtoLearning.models.icsn import iCSN
+
+
+def load_single_imgs(data_dir, split='train_probing', attrs=''):
+    """
+    Loads the single (unpaired) ECR images and label ids of a split, e.g. 'train_probing' or 'val', as min max
+    normalized float images [N, C, W, H] and label ids [N, G].
+    """
+    root = os.path.join(data_dir, 'ECR', split)
+    imgs = np.load(os.path.join(root, f"{split}_ecr{attrs}.npy"), allow_pickle=True)
+    imgs = (imgs - imgs.min()) / (imgs.max() - imgs.min())
+    imgs = torch.from_numpy(np.moveaxis(imgs, 3, 1)).float()
+    labels = data.load_labels(os.path.join(root, f"{split}_ecr{attrs}_labels.pkl"))['labels']
+    return imgs, torch.as_tensor(np.asarray(labels)).long()
+
+
+def load_icsn(ckpt_fp, device='cpu'):
+    """
+    Builds the iCSN of a checkpoint of train_icsn.py (or _rr, _spot) from its config and loads its weights.
+    """
+    # the prototypes are stored as modules, which are not loadable with weights_only
+    ckpt = torch.load(ckpt_fp, map_location=torch.device(device), weights_only=False)
+    config = ckpt['config']
+    model = iCSN(num_hiddens=64, num_residual_layers=2, num_residual_hiddens=64,
+                 n_proto_vecs=config['prototype_vectors'], lin_enc_size=config['lin_enc_size'],
+                 proto_dim=config['proto_dim'], softmax_temp=config['temperature'],
+                 extra_mlp_dim=config['extra_mlp_dim'],
+                 multiheads=config['multiheads'], train_protos=config['train_protos'],
+                 device=device)
+    model.load_state_dict(ckpt['model'])
+    model.proto_dict = ckpt['model_misc']['prototypes']
+    model.softmax_temp = ckpt['model_misc']['softmax_temp']
+    return model.to(device)
+
+
+def encode(model, imgs, batch_size=500, device='cpu'):
+    """
+    Encodes imgs in batches with model.forward_single and returns the codes [N, D] on the cpu.
+    """
+    model.eval()
+    codes = []
+    with torch.no_grad():
+        for i in range(0, len(imgs), batch_size):
+            preds, _ = model.forward_single(imgs[i:i + batch_size].to(device))
+            codes.append(preds.cpu())
+    return torch.cat(codes)
+
+
+def kfold_masks(n_samples, n_folds=5, seed=0):
+    """
+    Returns the boolean training masks [K, N] of a random k-fold split. All folds index the same codes tensor, i.e.
+    no per fold copies of the data are made, the held out samples of fold k are ~masks[k].
+    """
+    generator = torch.Generator().manual_seed(seed)
+    fold_ids = torch.empty(n_samples, dtype=torch.long)
+    fold_ids[torch.randperm(n_samples, generator=generator)] = torch.arange(n_samples) % n_folds
+    return fold_ids[None, :] != torch.arange(n_folds)[:, None]
+
+
+def fit_linear_probes(codes, labels, train_masks, c=0.316, max_iter=100):
+    """
+    Fits one multinomial logistic regression per checkpoint, fold and category in a single batched solve. The weights
+    are stacked to [M, K, G, C, D], i.e. one weight block per category (as coef_ of sklearn), categories with less than
+    C classes are masked. Each probe minimizes the objective of sklearn's LogisticRegression(C=c), scaled by 1 / (c * n_train):
+    the mean cross entropy of its training samples plus ||W||^2 / (2 * c * n_train). For binary categories the penalty
+    is doubled, so that the two class softmax equals the binary logistic regression of sklearn. As the probes are
+    independent, the sum of their objectives is minimized jointly with L-BFGS, the gradient of the softmax cross
+    entropy is computed in closed form instead of with autograd.
+    :param codes: float tensor [M, N, D], the codes of M checkpoints of the same images
+    :param labels: label ids [N, G]
+    :param train_masks: boolean training masks [K, N], e.g. from kfold_masks
+    :return: weights [M, K, G, C, D], biases [M, K, G, C] and the class mask [G, C]
+    """
+    (n_ckpts, n_samples, n_dims), n_folds, n_groups = codes.shape, train_masks.shape[0], labels.shape[1]
+    n_classes = labels.max(dim=0).values + 1
+    class_mask = torch.arange(n_classes.max())[None, :] < n_classes[:, None]
+
+    shape = (n_ckpts, n_folds, n_groups, class_mask.shape[1], n_dims)
+    weights = torch.zeros(shape, dtype=codes.dtype)
+    biases = torch.zeros(shape[:4], dtype=codes.dtype)
+    n_train = train_masks.sum(dim=1).to(codes.dtype)
+    reg_scale = ((1. + (n_classes == 2).to(codes.dtype)) / (2 * c * n_train[:, None]))[:, :, None, None]
+    # [K, 1, 1, N] weights of the training samples and [K, G, C, N] weighted one hot targets of each fold
+    sample_weights = (train_masks.to(codes.dtype) / n_train[:, None])[:, None, None, :]
+    targets = F.one_hot(labels.T, class_mask.shape[1]).transpose(1, 2).to(codes.dtype) * sample_weights
+
+    optimizer = torch.optim.LBFGS([weights, biases], max_iter=max_iter, tolerance_grad=1e-7, tolerance_change=1e-9,
+                                  history_size=20, line_search_fn='strong_wolfe')
+
+    label_ids = labels.T[None, None, :, None, :].expand(n_ckpts, n_folds, -1, 1, -1)
+
+    def closure():
+        log_probs = F.log_softmax(_probe_logits(codes, weights, biases, class_mask), dim=-2)
+        nll = -log_probs.gather(-2, label_ids).squeeze(-2)
+        loss = (nll * sample_weights[:, :, 0]).sum() + (weights.pow(2) * reg_scale).sum()
+        # gradient of the loss w.r.t. the logits, the log probabilities are not needed anymore and are overwritten
+        grad_logits = log_probs.exp_().mul_(sample_weights).sub_(targets)
+        grad_weights = torch.bmm(grad_logits.view(n_ckpts, -1, n_samples), codes).view(shape)
+        weights.grad = grad_weights + 2 * reg_scale * weights
+        biases.grad = grad_logits.sum(dim=-1)
+        return loss
+
+    optimizer.step(closure)
+    return weights, biases, class_mask
+
+
+def _probe_logits(codes, weights, biases, class_mask):
+    """
+    Logits [M, K, G, C, N] of all probes, padded classes are -inf. The samples are the last dimension, as the softmax
+    over a short last dimension is several times slower. The probes of a checkpoint are computed by a single matrix
+    product with its codes [N, D].
+    """
+    logits = torch.bmm(weights.view(weights.shape[0], -1, weights.shape[-1]), codes.transpose(1, 2))
+    offsets = biases.masked_fill(~class_mask, float('-inf'))
+    return logits.view(weights.shape[:4] + (-1,)) + offsets[..., None]
+
+
+def probe_accuracies(codes, labels, n_folds=5, c=0.316, max_iter=100, seed=0):
+    """
+    k-fold cross validated accuracy of linear probes of each category, all checkpoints use the same folds.
+    :param codes: float tensor [M, N, D], the codes of M checkpoints of the same images
+    :return: accuracies [M, K, G] in percent
+    """
+    codes = codes.float()
+    train_masks = kfold_masks(codes.shape[1], n_folds=n_folds, seed=seed)
+    weights, biases, class_mask = fit_linear_probes(codes, labels, train_masks, c=c, max_iter=max_iter)
+    with torch.no_grad():
+        preds = _probe_logits(codes, weights, biases, class_mask).argmax(dim=-2)
+    test_masks = (~train_masks)[:, None, :]
+    correct = ((preds == labels.T) & test_masks).sum(dim=-1)
+    return correct.float() / test_masks.sum(dim=-1) * 100.
+
+
+def probe_table(codes_dict, labels, n_folds=5, c=0.316, max_iter=100, seed=0):
+    """
+    Probes the codes of several models, each with one or more checkpoints (e.g. seeds), with the same folds. The
+    probes of all checkpoints with the same code size are fit in one solve.
+    :param codes_dict: dict of model name to list of codes [N, D], one per checkpoint
+    :return: dict of model name to the (mean, std) accuracies [G + 1] over all checkpoints and folds, the last entry
+    is the accuracy averaged over the categories
+    """
+    names = [name for name, codes_list in codes_dict.items() for _ in codes_list]
+    codes_all = [codes for codes_list in codes_dict.values() for codes in codes_list]
+    accs_all = [None] * len(codes_all)
+    for n_dims in set(codes.shape[1] for codes in codes_all):
+        ids = [i for i, codes in enumerate(codes_all) if codes.shape[1] == n_dims]
+        accs = probe_accuracies(torch.stack([codes_all[i] for i in ids]), labels, n_folds=n_folds, c=c,
+                                max_iter=max_iter, seed=seed)
+        for i, acc in zip(ids, accs):
+            accs_all[i] = acc
+
+    table = {}
+    for name in codes_dict:
+        accs = torch.cat([acc for acc, acc_name in zip(accs_all, names) if acc_name == name])
+        accs = torch.cat((accs, accs.mean(dim=1, keepdim=True)), dim=1)
+        table[name] = (accs.mean(dim=0), accs.std(dim=0) if len(accs) > 1 else torch.zeros(accs.shape[1]))
+    return table
+
+
+def print_table(table):
+    n_groups = len(next(iter(table.values()))[0]) - 1
+    print(f"{'model':>12} " + ' '.join(f"{f'category {g}':>15}" for g in range(n_groups)) + f" {'mean':>15}")
+    for name, (mean, std) in table.items():
+        print(f"{name:>12} " + ' '.join(f"{m:>7.2f} +- {s:>5.2f}" for m, s in zip(mean.tolist(), std.tolist())))
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, nargs='+', action='append', required=True, metavar=('NAME', 'CKPT'),
+                        help='name of a model followed by the file paths of its checkpoints, can be given repeatedly')
+    parser.add_argument('-dd', '--data-dir', type=str, default='Data', help='data root directory')
+    parser.add_argument('--split', type=str, default='train_probing', help='ECR split to probe on')
+    parser.add_argument('--attrs', type=str, default='', help="ECR variant, '', '_spot' or '_nospot'")
+    parser.add_argument('--n-folds', type=int, default=5, help='number of cross validation folds')
+    parser.add_argument('--c', type=float, default=0.316,
+                        help='inverse regularization strength, as C of sklearn LogisticRegression')
+    parser.add_argument('--max-iter', type=int, default=100, help='maximum number of L-BFGS iterations')
+    parser.add_argument('-bs', '--batch-size', type=int, default=500, help='batch size to encode the images')
+    parser.add_argument('--device', type=str, default='cpu', help='device to be used')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='seed of the folds')
+    return parser
+
+
+if __name__ == '__main__':
+    # e.g. python experiments/ProtoLearning/probing.py --data-dir Data \
+    #          --model icsn experiments/ProtoLearning/runs/icsn-0-ecr/states/07999.pth \
+    #          experiments/ProtoLearning/runs/icsn-1-ecr/states/07999.pth \
+    #          --model icsn_rr experiments/ProtoLearning/runs/icsn-rr-0-ecr/states/07999.pth
+    args = _get_parser().parse_args(sys.argv[1:])
+    utils.set_seed(args.seed)
+
+    imgs, labels = load_single_imgs(args.data_dir, split=args.split, attrs=args.attrs)
+
+    # every checkpoint is encoded once, all probes of all folds are then fit from its codes
+    start = time.time()
+    codes_dict = {name: [encode(load_icsn(ckpt_fp, args.device), imgs, args.batch_size, args.device)
+                         for ckpt_fp in ckpt_fps]
+                  for name, *ckpt_fps in args.model}
+    print(f'encoded {len(imgs)} images in {time.time() - start:.2f}s')
+
+    start = time.time()
+    table = probe_table(codes_dict, labels, n_folds=args.n_folds, c=args.c, max_iter=args.max_iter, seed=args.seed)
+    print(f'fit probes in {time.time() - start:.2f}s')
+    print_table(table)
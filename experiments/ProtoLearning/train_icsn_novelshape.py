@@ -125,14 +125,16 @@ def train(model, data_loader, log_samples, optimizer, scheduler, writer, cur_epo
     model.train()
     model.softmax_temp = 1.
 
+    # anomaly detection records every op of the forward pass and is thus only enabled for debugging, otherwise
+    # a lightweight check on the loss and gradients is run every step
+    torch.autograd.set_detect_anomaly(config['debug_anomaly'])
+
     for e in range(0, 600):
         start = time.time()
 
         loss_dict = dict(
             {'loss': 0, "recon_loss": 0, "binding_loss": 0})
 
-        torch.autograd.set_detect_anomaly(True)
-
         for i, batch in enumerate(data_loader):
 
             imgs, gt_labels_one_hot = batch
@@ -167,6 +169,7 @@ def train(model, data_loader, log_samples, optimizer, scheduler, writer, cur_epo
 
             optimizer.zero_grad()
             loss.backward()
+            utils.check_finite(loss, model, step=e * len(data_loader) + i)
             optimizer.step()
 
             loss_dict['recon_loss'] += ave_recon_loss.item() if config['lambda_recon_proto'] > 0. else 0.
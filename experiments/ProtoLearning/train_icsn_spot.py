@@ -24,13 +24,18 @@ def train(model, data_loader, log_samples, optimizer, scheduler, writer, cur_epo
 
     warmup_steps = cur_epoch * len(data_loader)
 
+    # anomaly detection records every op of the forward pass and is thus only enabled for debugging, otherwise
+    # a lightweight check on the loss and gradients is run every step
+    torch.autograd.set_detect_anomaly(config['debug_anomaly'])
+
+    ckpt_writer = utils.AsyncCheckpointWriter(max_to_keep=config['keep_ckpts'])
+
     for e in range(cur_epoch, config['epochs']):
         max_iter = len(data_loader)
         start = time.time()
         loss_dict = dict(
             {'loss': 0, 'proto_recon_loss': 0, 'rr_loss': 0})
 
-        torch.autograd.set_detect_anomaly(True)
         for i, batch in enumerate(data_loader):
 
             # manual lr warmup
@@ -89,7 +94,8 @@ def train(model, data_loader, log_samples, optimizer, scheduler, writer, cur_epo
             elif e >= 1000:
                 model.softmax_temp = .1
 
-            preds, proto_recons = model.forward(imgs, shared_labels)
+            # the losses below only require the predictions and the reconstructions of the swapped codes
+            preds, proto_recons = model.forward(imgs, shared_labels, outputs=('preds', 'recons_swap'))
 
             # to prevent forgetting
             rr_loss0 = F.mse_loss(preds[0][:, :18], labels0_one_hot)
@@ -108,6 +114,7 @@ def train(model, data_loader, log_samples, optimizer, scheduler, writer, cur_epo
 
             optimizer.zero_grad()
             loss.backward()
+            utils.check_finite(loss, model, step=e * len(data_loader) + i)
             optimizer.step()
 
             if config['lr_scheduler'] and warmup_steps > config['lr_scheduler_warmup_steps']:
@@ -147,7 +154,7 @@ def train(model, data_loader, log_samples, optimizer, scheduler, writer, cur_epo
                 'config': config
             }
             # torch.save(state, os.path.join(writer.log_dir, f"{config['exp_name']}.pth"))
-            torch.save(state, os.path.join(config['model_dir'], '%05d.pth' % (e)))
+            ckpt_writer.save(state, os.path.join(config['model_dir'], '%05d.pth' % (e)))
 
             # TODO: how to plot the prorotypes with extra encoding?
             if config['extra_mlp_dim'] == 0.:
@@ -158,6 +165,8 @@ def train(model, data_loader, log_samples, optimizer, scheduler, writer, cur_epo
 
             print(f'SAVED - epoch {e} - imgs @ {config["img_dir"]} - model @ {config["model_dir"]}')
 
+    ckpt_writer.close()
+
 
 def test(model, log_samples, writer, config):
     utils.plot_test_examples(log_samples, model, writer, config, step=0)
@@ -18,6 +18,8 @@ def _get_parser():
 
     parser.add_argument('--save-step', type=int, default=50,
                         help='save model every # steps')
+    parser.add_argument('--keep-ckpts', type=int, default=None,
+                        help='number of most recent checkpoints to keep, older ones are deleted. Keeps all by default')
     parser.add_argument('--print-step', type=int, default=10,
                         help='print metrics every # steps')
     parser.add_argument('--display-step', type=int, default=1,
@@ -44,6 +46,15 @@ def _get_parser():
                         help='batch size')
     parser.add_argument('--n-workers', type=int, default=2,
                         help='workers to load data')
+    parser.add_argument('--data-storage', type=str, default='memory', choices=['memory', 'uint8', 'mmap'],
+                        help="how the image pairs are stored, 'memory': normalized float arrays, 'uint8': uint8 "
+                             "[N, 2, C, W, H] arrays cached beside the data files, scaled to float per batch, "
+                             "'mmap': memory mapped raw arrays, normalized per batch")
+    parser.add_argument('--batch-loading', action='store_true',
+                        help='should whole batches be gathered at once instead of collating single samples?')
+    parser.add_argument('--save-label-sidecar', action='store_true',
+                        help='should the labels and shared masks be converted to the columnar npz format beside the '
+                             'label pickle files, which are then memory mapped instead of unpickled?')
 
     parser.add_argument('-pv', '--prototype-vectors', type=int , nargs='+', default=[2, 3],
                         help='List of img shape dims [#p1, #p2, ...]')
@@ -58,6 +69,9 @@ def _get_parser():
     #                     help='should an extra softmax be added after the dot product scoring?')
     parser.add_argument('--multiheads', action='store_true',
                         help='should multiple mlp heads be used each for one category?')
+    parser.add_argument('--fused-views', action='store_true',
+                        help='should both images of a pair be encoded and all codes be decoded as one batch each? '
+                             'Note that BatchNorm then computes its batch statistics over the fused batch.')
 
     parser.add_argument('--lin-enc-size', type=int, default=512,
                         help='latent dimensions of linear encoder after main encoder')
@@ -81,6 +95,11 @@ def _get_parser():
     parser.add_argument('-dd', '--data-dir', type=str, default='Data',
                         help='data root directory')
 
+    parser.add_argument('--debug-anomaly', action='store_true',
+                        help='should autograd anomaly detection be enabled? This records the forward pass of every op '
+                             'to locate NaN/Inf gradients, but slows down training considerably. Without it only a '
+                             'lightweight NaN/Inf check on the loss and gradients is run every step.')
+
     parser.add_argument('-s', '--seed', type=int, default=42,
                         help='random seed')
 
@@ -0,0 +1,225 @@
+import argparse
+import sys
+import time
+
+import copy
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+import icsn.data as data
+import icsn.utils as utils
+from icsn.models.icsn import iCSN
+from icsn.models.introae import Encoder, Decoder
+
+
+def _timeit(fct, n_repeats, device):
+    """
+    Returns the mean wall clock time in ms of fct over n_repeats calls, after one warmup call.
+    """
+    fct()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(n_repeats):
+        fct()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / n_repeats * 1000
+
+
+def _get_small_icsn(n_proto_vecs, proto_dim, device, channels=[8, 8, 8, 8], hdim=64):
+    """
+    iCSN with an introae encoder and decoder, which by default are small for benchmarking the parts of the model
+    after the encoder.
+    """
+    encoder = Encoder(3, hdim, channels, 64)
+    decoder = Decoder(3, hdim, channels, 64)
+    model = iCSN(encoder=encoder, decoder=decoder, n_proto_vecs=n_proto_vecs, lin_enc_size=hdim, proto_dim=proto_dim,
+                 extra_mlp_dim=1, multiheads=True, train_protos=True, image_size=(64, 64), device=device)
+    return model.to(device)
+
+
+def _train_step(model, optimizer, imgs, shared_masks, check_finite=False, **forward_kwargs):
+    """
+    One training step with the loss of icsn/train_icsn.py, returns the loss value.
+    """
+    preds, proto_recons = model.forward_pairs({'data': imgs, 'shared_masks': shared_masks}, **forward_kwargs)
+    loss = (F.mse_loss(proto_recons[2], imgs[0]) + F.mse_loss(proto_recons[3], imgs[1])) / 2
+
+    optimizer.zero_grad()
+    loss.backward()
+    if check_finite:
+        utils.check_finite(loss, model, step=0)
+    optimizer.step()
+    return loss.item()
+
+
+def bench_proto_dists(args):
+    """
+    Compares the per group loop version of the prototype similarity computation with the batched version for
+    different numbers of groups and prototypes per group.
+    """
+    print(f"{'groups':>6} {'protos':>6} {'loop [ms]':>10} {'batched [ms]':>12} {'speedup':>8} {'max abs diff':>12}")
+    for n_groups in args.n_groups:
+        for n_protos in args.n_protos:
+            # ragged groups: the last group has one prototype less than the others, if possible
+            n_proto_vecs = [n_protos] * n_groups
+            n_proto_vecs[-1] = max(1, n_protos - 1)
+            model = _get_small_icsn(n_proto_vecs, args.proto_dim, args.device)
+
+            inputs0 = torch.randn(args.batch_size, n_groups, args.proto_dim, device=args.device)
+            inputs1 = torch.randn(args.batch_size, n_groups, args.proto_dim, device=args.device)
+            shared_masks = torch.rand(args.batch_size, n_groups, device=args.device) > 0.5
+
+            with torch.no_grad():
+                out_loop = model._comp_proto_dists_loop(inputs0, inputs1, shared_masks)[1]
+                out_batched = model._comp_proto_dists(inputs0, inputs1, shared_masks)[1]
+                max_diff = max([(a - b).abs().max().item() for a, b in zip(out_loop, out_batched)])
+
+                time_loop = _timeit(lambda: model._comp_proto_dists_loop(inputs0, inputs1, shared_masks),
+                                    args.n_repeats, args.device)
+                time_batched = _timeit(lambda: model._comp_proto_dists(inputs0, inputs1, shared_masks),
+                                       args.n_repeats, args.device)
+
+            print(f"{n_groups:>6} {n_protos:>6} {time_loop:>10.3f} {time_batched:>12.3f} "
+                  f"{time_loop / time_batched:>7.1f}x {max_diff:>12.2e}")
+
+
+def bench_loader(args):
+    """
+    Compares the throughput in samples/sec of the per sample DataLoader with the batch level DataLoader of
+    icsn/data.py for all requested data storages.
+    """
+    print(f"{'storage':>8} {'workers':>7} {'per sample [samples/s]':>22} {'batched [samples/s]':>19} {'speedup':>8}")
+    for storage in args.data_storage:
+        throughputs = []
+        for batch_loading in [False, True]:
+            config = {'dataset': args.dataset, 'data_dir': args.data_dir, 'batch_size': args.batch_size,
+                      'n_workers': args.n_workers, 'data_storage': storage, 'batch_loading': batch_loading,
+                      'save_label_sidecar': False}
+            data_loader = data.get_dataloader(config)
+
+            # warmup, e.g. worker startup and cache creation
+            next(iter(data_loader))
+
+            n_samples = 0
+            start = time.perf_counter()
+            for i, batch in enumerate(data_loader):
+                n_samples += batch[0][0].shape[0]
+                if i + 1 == args.n_batches:
+                    break
+            throughputs.append(n_samples / (time.perf_counter() - start))
+
+        print(f"{storage:>8} {args.n_workers:>7} {throughputs[0]:>22.0f} {throughputs[1]:>19.0f} "
+              f"{throughputs[1] / throughputs[0]:>7.1f}x")
+
+
+def bench_step(args):
+    """
+    Compares the training step time of forward_pairs with one encoder/decoder call per view, with skipping the
+    decoding of the non-swapped views and with additionally fusing all views into one batch. Every variant starts from
+    the same weights, the loss of the first step shows whether the variant changes the computation.
+    """
+    n_proto_vecs = [args.n_protos[0]] * args.n_groups[0]
+    model = _get_small_icsn(n_proto_vecs, args.proto_dim, args.device, channels=args.channels, hdim=args.hdim)
+    model.train()
+    init_state = copy.deepcopy(model.state_dict())
+
+    imgs = (torch.rand(args.batch_size, 3, 64, 64, device=args.device),
+            torch.rand(args.batch_size, 3, 64, 64, device=args.device))
+    shared_masks = torch.rand(args.batch_size, len(n_proto_vecs), device=args.device) > 0.5
+
+    variants = [('all views', {}),
+                ('swapped views', {'outputs': ('recons_swap',)}),
+                ('fused swapped views', {'outputs': ('recons_swap',), 'fused': True})]
+
+    print(f"{'variant':>20} {'step [ms]':>10} {'speedup':>8} {'first loss':>12}")
+    for name, forward_kwargs in variants:
+        model.load_state_dict(init_state)
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+        first_loss = _train_step(model, optimizer, imgs, shared_masks, **forward_kwargs)
+        step_time = _timeit(lambda: _train_step(model, optimizer, imgs, shared_masks, **forward_kwargs),
+                            args.n_repeats, args.device)
+        if not forward_kwargs:
+            base_time = step_time
+        print(f"{name:>20} {step_time:>10.1f} {base_time / step_time:>7.2f}x {first_loss:>12.8f}")
+
+
+def bench_anomaly(args):
+    """
+    Compares the training step time without any checks, with the NaN/Inf watchdog of icsn/utils.py, which runs by
+    default, and with autograd anomaly detection, which is only enabled with --debug-anomaly.
+    """
+    n_proto_vecs = [args.n_protos[0]] * args.n_groups[0]
+    model = _get_small_icsn(n_proto_vecs, args.proto_dim, args.device, channels=args.channels, hdim=args.hdim)
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+
+    imgs = (torch.rand(args.batch_size, 3, 64, 64, device=args.device),
+            torch.rand(args.batch_size, 3, 64, 64, device=args.device))
+    shared_masks = torch.rand(args.batch_size, len(n_proto_vecs), device=args.device) > 0.5
+
+    variants = [('no checks', False, False),
+                ('nan/inf watchdog', True, False),
+                ('anomaly detection', False, True)]
+
+    print(f"{'variant':>20} {'step [ms]':>10} {'slowdown':>9}")
+    for name, check_finite, debug_anomaly in variants:
+        with torch.autograd.set_detect_anomaly(debug_anomaly):
+            step_time = _timeit(lambda: _train_step(model, optimizer, imgs, shared_masks, check_finite=check_finite,
+                                                    outputs=('recons_swap',)),
+                                args.n_repeats, args.device)
+        if not check_finite and not debug_anomaly:
+            base_time = step_time
+        print(f"{name:>20} {step_time:>10.1f} {step_time / base_time:>8.2f}x")
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', type=str, choices=['proto_dists', 'loader', 'step', 'anomaly'],
+                        help='which benchmark to run')
+    parser.add_argument('--device', type=str, default='cpu',
+                        help='device to be used')
+    parser.add_argument('-bs', '--batch-size', type=int, default=500,
+                        help='batch size, for paired benchmarks this is the batch size of pairs')
+    parser.add_argument('--n-repeats', type=int, default=50,
+                        help='number of timed repetitions')
+    parser.add_argument('--n-groups', type=int, nargs='+', default=[2, 3, 6, 12],
+                        help='number of prototype groups to benchmark')
+    parser.add_argument('--n-protos', type=int, nargs='+', default=[2, 6, 16],
+                        help='number of prototypes per group to benchmark')
+    parser.add_argument('--proto-dim', type=int, default=128,
+                        help='dimensions of each prototype encoding')
+    parser.add_argument('--channels', type=int, nargs='+', default=[64, 128, 256, 512],
+                        help='channels of the introae encoder and decoder for the step and anomaly benchmarks')
+    parser.add_argument('--hdim', type=int, default=512,
+                        help='latent dimensions of the introae encoder for the step and anomaly benchmarks')
+    parser.add_argument('-d', '--dataset', type=str, default='ecr',
+                        help="ecr, ecr_spot or ecr_nospot")
+    parser.add_argument('-dd', '--data-dir', type=str, default='Data',
+                        help='data root directory')
+    parser.add_argument('--data-storage', type=str, nargs='+', default=['memory', 'uint8', 'mmap'],
+                        help='data storages to benchmark')
+    parser.add_argument('--n-workers', type=int, default=0,
+                        help='workers to load data')
+    parser.add_argument('--n-batches', type=int, default=20,
+                        help='number of timed batches')
+    return parser
+
+
+if __name__ == '__main__':
+    # e.g. PYTHONPATH=. python icsn/benchmark.py proto_dists --device cpu
+    # or PYTHONPATH=. python icsn/benchmark.py loader --data-dir data/ECR --n-workers 2
+    args = _get_parser().parse_args(sys.argv[1:])
+    torch.manual_seed(0)
+    np.random.seed(0)
+
+    if args.benchmark == 'proto_dists':
+        bench_proto_dists(args)
+    elif args.benchmark == 'loader':
+        bench_loader(args)
+    elif args.benchmark == 'step':
+        bench_step(args)
+    elif args.benchmark == 'anomaly':
+        bench_anomaly(args)
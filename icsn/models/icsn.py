@@ -3,6 +3,9 @@ import torch.nn as nn
 import numpy as np
 from icsn.models.torch_truncnorm.TruncatedNormal import TruncatedNormal
 
+# outputs of iCSN.forward_pairs that can be requested
+PAIR_OUTPUTS = ('preds', 'recons', 'recons_swap')
+
 
 class iCSN(nn.Module):
 	def __init__(self, encoder, decoder, n_proto_vecs=[4, 2],
@@ -72,6 +75,7 @@ class iCSN(nn.Module):
 			)
 
 		self.proto_layer = self.init_prototypes()
+		self.init_proto_padding()
 
 		self.softmax = nn.Softmax(dim=1)
 		# Separate n_groups channels into n_groups (equivalent with InstanceNorm)
@@ -89,6 +93,20 @@ class iCSN(nn.Module):
 			# protottypes are not learnable
 			self.proto_dict[str(group_id)].weight.requires_grad = self.train_protos
 
+	def init_proto_padding(self):
+		"""
+		Precomputes the index buffers required for stacking the prototypes of all groups into one zero padded tensor
+		of shape [G, P_max, D], with P_max being the largest number of prototypes over all groups.
+		"""
+		max_protos = max(self.n_proto_vecs)
+		# [G, P_max], True for slots that hold an actual prototype, False for padded slots
+		proto_mask = torch.arange(max_protos).unsqueeze(dim=0) < torch.tensor(self.n_proto_vecs).unsqueeze(dim=1)
+		# group id of each attribute in the one hot code, e.g. [0, 0, 1, 1, 1] for n_proto_vecs=[2, 3]
+		attr_group_ids = torch.repeat_interleave(torch.arange(self.n_groups), torch.tensor(self.n_proto_vecs))
+		# non persistent so that state dicts of older checkpoints remain loadable
+		self.register_buffer('proto_mask', proto_mask.to(self.device), persistent=False)
+		self.register_buffer('attr_group_ids', attr_group_ids.to(self.device), persistent=False)
+
 	def update_softmax_temp(self, epoch):
 		# if current step (e.g. epoch) is at relevant count then decrease temperature by temp_scheduler_rate
 		if epoch > 0:
@@ -102,7 +120,18 @@ class iCSN(nn.Module):
 	def forward(self, kwargs):
 		return self.forward_single(kwargs)
 
-	def forward_pairs(self, data_dict):
+	def forward_pairs(self, data_dict, fused=False, outputs=PAIR_OUTPUTS):
+		"""
+		:param data_dict: dict with the image pair tuple 'data' and the [B, G] bool 'shared_masks'
+		:param fused: encode both images and decode all codes as one batch each, instead of one call per view. Note
+		that layers depending on batch statistics, i.e. BatchNorm in train mode, then normalize over the fused batch.
+		:param outputs: which outputs to compute, any of 'preds' (pred0, pred1), 'recons' (reconstructions of the
+		non-swapped codes) and 'recons_swap' (reconstructions of the swapped codes). Outputs that are not requested are
+		not computed and returned as None.
+		:return: (pred0, pred1), (z0_proto_recon, z1_proto_recon, z0_proto_recon_swap, z1_proto_recon_swap)
+		"""
+		assert set(outputs) <= set(PAIR_OUTPUTS), f'Unknown outputs {outputs}'
+
 		imgs = data_dict['data']
 		shared_masks = data_dict['shared_masks']
 		# if current step (e.g. epoch) is at relevant count then decrease temperature by temp_scheduler_rate
@@ -112,17 +141,25 @@ class iCSN(nn.Module):
 
 		self.batch_size = x0.shape[0]
 
-		# x: [B, 3, 64, 64] --> [B, F, W, H] --> [B, D]
-		z0 = self.encode(x0)
-		z1 = self.encode(x1)
+		if fused:
+			# x: [2B, 3, 64, 64] --> [2B, F, W, H] --> [2B, D]
+			z = self.encode(torch.cat((x0, x1), dim=0))
+			# extracts additional information important for reconstruction, but not relevant as a concept
+			z0_extra, z1_extra = self.extra_mlp(z).split(self.batch_size)
+			# [2B, D] --> [2B, G, D_P], D_P = D/G
+			z0, z1 = self.split(z).split(self.batch_size)
+		else:
+			# x: [B, 3, 64, 64] --> [B, F, W, H] --> [B, D]
+			z0 = self.encode(x0)
+			z1 = self.encode(x1)
 
-		# extracts additional information important for reconstruction, but not relevant as a concept
-		z0_extra = self.extra_mlp(z0)
-		z1_extra = self.extra_mlp(z1)
+			# extracts additional information important for reconstruction, but not relevant as a concept
+			z0_extra = self.extra_mlp(z0)
+			z1_extra = self.extra_mlp(z1)
 
-		# [B, D] --> [B, G, D_P], D_P = D/G
-		z0 = self.split(z0)
-		z1 = self.split(z1)
+			# [B, D] --> [B, G, D_P], D_P = D/G
+			z0 = self.split(z0)
+			z1 = self.split(z1)
 
 		# compute distance to prototype embeddings and return softmin distance as label prediction
 		(z0_proto, z1_proto), (pred0, pred1, pred0_swap, pred1_swap) = self._comp_proto_dists(z0, z1, shared_masks)
@@ -132,14 +169,25 @@ class iCSN(nn.Module):
 		pred0_swap = torch.cat((pred0_swap, z0_extra), dim=1)
 		pred1_swap = torch.cat((pred1_swap, z1_extra), dim=1)
 
-		# convert codes and extra encoding via decoder to reconstruction
-		z0_proto_recon = self.proto_decode(pred0)
-		z1_proto_recon = self.proto_decode(pred1)
-		z0_proto_recon_swap = self.proto_decode(pred0_swap)
-		z1_proto_recon_swap = self.proto_decode(pred1_swap)
+		# convert the requested codes and extra encoding via decoder to reconstruction
+		codes = [pred0, pred1, pred0_swap, pred1_swap]
+		decode_ids = [i for i, output in enumerate(['recons', 'recons', 'recons_swap', 'recons_swap'])
+		              if output in outputs]
+		proto_recons = [None] * len(codes)
+		if fused and decode_ids:
+			fused_recons = self.proto_decode(torch.cat([codes[i] for i in decode_ids], dim=0)).split(self.batch_size)
+			for i, recon in zip(decode_ids, fused_recons):
+				proto_recons[i] = recon
+		else:
+			for i in decode_ids:
+				proto_recons[i] = self.proto_decode(codes[i])
+		z0_proto_recon, z1_proto_recon, z0_proto_recon_swap, z1_proto_recon_swap = proto_recons
 
 		# remove the continuous variables from the final prediction
-		if self.extra_mlp_dim != 0.:
+		if 'preds' not in outputs:
+			pred0 = None
+			pred1 = None
+		elif self.extra_mlp_dim != 0.:
 			pred0 = pred0[:, :-self.extra_mlp_dim]
 			pred1 = pred1[:, :-self.extra_mlp_dim]
 
@@ -177,6 +225,18 @@ class iCSN(nn.Module):
 		# proto_embeddings = self.proto_layer_norm[group_id](proto_embeddings.permute(1, 0)).permute(1, 0)
 		return proto_embeddings
 
+	def get_stacked_prototype_embeddings(self):
+		"""
+		Stacks the prototypes of all groups into one zero padded tensor.
+		:return: [G, P_max, D]
+		"""
+		# [N_Attrs, D]
+		proto_embeddings = torch.cat([self.get_prototype_embeddings(group_id) for group_id in range(self.n_groups)],
+		                             dim=0)
+		stacked = proto_embeddings.new_zeros(self.proto_mask.shape + (self.proto_dim,))
+		stacked[self.proto_mask] = proto_embeddings
+		return stacked
+
 	def split(self, z):
 		if self.multiheads:
 			z = torch.stack([self.split_mlps[i].forward(z) for i in range(self.n_groups)]).permute(1, 0, 2)
@@ -207,7 +267,58 @@ class iCSN(nn.Module):
 	def _comp_proto_dists(self, inputs0, inputs1, shared_masks):
 		"""
 		Computes the distance between each encoding to the prototype vectors and creates a latent prototype vector for
-		each image.
+		each image. All groups are processed at once, see _comp_proto_dists_loop for the per group reference version.
+		:param inputs0: [B, G, D]
+		:param inputs1: [B, G, D]
+		:param shared_masks: [B, G], groups beyond shared_masks.shape[1] are never swapped
+		:return:
+		"""
+		# [B, G, P_max] --> [B, N_Attrs]
+		distances0_emb = self.softmax_dot_product_batched(inputs0)[:, self.proto_mask]
+		distances1_emb = self.softmax_dot_product_batched(inputs1)[:, self.proto_mask]
+
+		# shared_labels: 0 means the attributes should not be shared, otherwise it should
+		# [B, G'] --> [B, G] --> [B, N_Attrs]
+		shared_masks = shared_masks.bool().reshape(distances0_emb.shape[0], -1)
+		if shared_masks.shape[1] < self.n_groups:
+			shared_masks = torch.cat((shared_masks,
+			                          shared_masks.new_zeros(shared_masks.shape[0],
+			                                                 self.n_groups - shared_masks.shape[1])), dim=1)
+		bool_share = shared_masks[:, self.attr_group_ids]
+
+		# swap the distances for those attributes to be shared
+		distances0_emb_swap = torch.where(bool_share, distances1_emb, distances0_emb)
+		distances1_emb_swap = torch.where(bool_share, distances0_emb, distances1_emb)
+
+		z0_protos = None
+		z1_protos = None
+
+		return (z0_protos, z1_protos), (distances0_emb, distances1_emb, distances0_emb_swap, distances1_emb_swap)
+
+	def _comp_proto_dists_single(self, inputs):
+		"""
+		Computes the distance between each encoding to the prototype vectors and creates a latent prototype vector for
+		each image. All groups are processed at once, see _comp_proto_dists_single_loop for the per group reference
+		version.
+		:param inputs: [B, G, D]
+		:return:
+		"""
+		# [B, G, P_max]
+		distances = self.softmax_dot_product_batched(inputs)
+
+		# get prototype indices for each image, padded slots have a score of 0 and are never selected, [B, G]
+		encoding_indices = torch.argmax(distances, dim=2)
+
+		# [G, P_max, D] --> [B, G, D]
+		proto_embeddings = self.get_stacked_prototype_embeddings()
+		z_protos = proto_embeddings[torch.arange(self.n_groups, device=encoding_indices.device), encoding_indices]
+
+		return z_protos, distances[:, self.proto_mask]
+
+	def _comp_proto_dists_loop(self, inputs0, inputs1, shared_masks):
+		"""
+		Reference implementation of _comp_proto_dists that iterates over the groups and prototypes. Kept for
+		benchmarking and testing the batched version.
 		:param inputs0:
 		:param inputs1:
 		:param shared_masks:
@@ -281,10 +392,10 @@ class iCSN(nn.Module):
 
 		return (z0_protos, z1_protos), (distances0_emb, distances1_emb, distances0_emb_swap, distances1_emb_swap)
 
-	def _comp_proto_dists_single(self, inputs):
+	def _comp_proto_dists_single_loop(self, inputs):
 		"""
-		Computes the distance between each encoding to the prototype vectors and creates a latent prototype vector for
-		each image.
+		Reference implementation of _comp_proto_dists_single that iterates over the groups and prototypes. Kept for
+		benchmarking and testing the batched version.
 		:param inputs0:
 		:param inputs1:
 		:param shared_masks:
@@ -347,3 +458,23 @@ class iCSN(nn.Module):
 		sim_scores = self.softmax((1./self.softmax_temp) * sim_scores)
 
 		return sim_scores
+
+	def softmax_dot_product_batched(self, inputs):
+		"""
+		softmax product as in MarioNette (Smirnov et al. 2021), computed for all groups at once via the zero padded
+		prototype tensor. Padded prototype slots are masked out of both softmax operations.
+		:param inputs: [B, G, D]
+		:return: [B, G, P_max], similarity scores with 0 at padded prototype slots
+		"""
+		# [G, P_max, D]
+		proto_embeddings = self.get_stacked_prototype_embeddings()
+
+		# [B, G, D] x [G, P_max, D] --> [B, G, P_max]
+		logits = torch.einsum('bgd,gpd->bgp', inputs, proto_embeddings) / np.sqrt(self.proto_dim)
+		sim_scores = torch.softmax(logits.masked_fill(~self.proto_mask, float('-inf')), dim=2)
+
+		# apply extra softmax to possibly enforce one-hot encoding
+		sim_scores = torch.softmax(((1./self.softmax_temp) * sim_scores).masked_fill(~self.proto_mask, float('-inf')),
+		                           dim=2)
+
+		return sim_scores
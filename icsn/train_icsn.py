@@ -25,6 +25,12 @@ def train(model, data_loader, test_loader, optimizer, writer, cur_epoch, config)
 
     warmup_steps = cur_epoch * len(data_loader)
 
+    # anomaly detection records every op of the forward pass and is thus only enabled for debugging, otherwise
+    # a lightweight check on the loss and gradients is run every step
+    torch.autograd.set_detect_anomaly(config['debug_anomaly'])
+
+    ckpt_writer = utils.AsyncCheckpointWriter(max_to_keep=config['keep_ckpts'])
+
     for e in range(cur_epoch, config['epochs']):
         max_iter = len(data_loader)
         start = time.time()
@@ -39,7 +45,6 @@ def train(model, data_loader, test_loader, optimizer, writer, cur_epoch, config)
         # softmax temperature scheduling
         model.update_softmax_temp(e)
 
-        torch.autograd.set_detect_anomaly(True)
         for i, batch in enumerate(data_loader):
 
             # manual lr warmup
@@ -55,8 +60,10 @@ def train(model, data_loader, test_loader, optimizer, writer, cur_epoch, config)
             imgs = (imgs0, imgs1)
             shared_masks = shared_masks.to(config['device'])
 
-            # forward pass with pairs of images and the ids of shared factors
-            preds, proto_recons = model.forward_pairs({'data': imgs, 'shared_masks': shared_masks})
+            # forward pass with pairs of images and the ids of shared factors, the loss below only requires the
+            # reconstructions of the swapped codes
+            preds, proto_recons = model.forward_pairs({'data': imgs, 'shared_masks': shared_masks},
+                                                      fused=config['fused_views'], outputs=('recons_swap',))
 
             # reconstruciton loss
             # recon_loss_z0_proto = F.mse_loss(proto_recons[0], imgs0)
@@ -69,6 +76,7 @@ def train(model, data_loader, test_loader, optimizer, writer, cur_epoch, config)
 
             optimizer.zero_grad()
             loss.backward()
+            utils.check_finite(loss, model, step=e * len(data_loader) + i)
             optimizer.step()
 
             loss_dict['proto_recon_loss'] += ave_recon_loss_proto.item() if config['lambda_recon_proto'] > 0. else 0.
@@ -104,7 +112,7 @@ def train(model, data_loader, test_loader, optimizer, writer, cur_epoch, config)
                 'config': config
             }
             # torch.save(state, os.path.join(writer.log_dir, f"{config['exp_name']}.pth"))
-            torch.save(state, os.path.join(config['model_dir'], '%05d.pth' % (e)))
+            ckpt_writer.save(state, os.path.join(config['model_dir'], '%05d.pth' % (e)))
 
             # plot a few samples with recon
             imgs = next(iter(test_loader))
@@ -116,6 +124,8 @@ def train(model, data_loader, test_loader, optimizer, writer, cur_epoch, config)
 
             print(f'SAVED - epoch {e} - imgs @ {config["img_dir"]} - model @ {config["model_dir"]}')
 
+    ckpt_writer.close()
+
 
 def test(model, test_loader, writer, config):
     # plot a few samples with recon
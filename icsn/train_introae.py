@@ -26,13 +26,18 @@ def train(model, data_loader, test_loader, optimizer, writer, cur_epoch, config)
 
     print("Begin training!")
 
+    # anomaly detection records every op of the forward pass and is thus only enabled for debugging, otherwise
+    # a lightweight check on the loss and gradients is run every step
+    torch.autograd.set_detect_anomaly(config['debug_anomaly'])
+
+    ckpt_writer = utils.AsyncCheckpointWriter(max_to_keep=config['keep_ckpts'])
+
     for e in range(cur_epoch, config['epochs']):
         max_iter = len(data_loader)
         start = time.time()
         loss_dict = dict(
             {'loss': 0})
 
-        torch.autograd.set_detect_anomaly(True)
         for i, batch in tqdm(enumerate(data_loader)):
             # manual lr warmup
             if warmup_steps < config['lr_scheduler_warmup_steps']:
@@ -54,6 +59,7 @@ def train(model, data_loader, test_loader, optimizer, writer, cur_epoch, config)
 
             optimizer.zero_grad()
             loss.backward()
+            utils.check_finite(loss, model, step=e * len(data_loader) + i)
             optimizer.step()
 
         for key in loss_dict.keys():
@@ -83,7 +89,7 @@ def train(model, data_loader, test_loader, optimizer, writer, cur_epoch, config)
                 'config': config
             }
             # torch.save(state, os.path.join(writer.log_dir, f"{config['exp_name']}.pth"))
-            torch.save(state, os.path.join(config['model_dir'], '%05d.pth' % (e)))
+            ckpt_writer.save(state, os.path.join(config['model_dir'], '%05d.pth' % (e)))
 
             # plot a few samples with recon
             imgs = next(iter(test_loader))
@@ -93,6 +99,8 @@ def train(model, data_loader, test_loader, optimizer, writer, cur_epoch, config)
 
             print(f'SAVED - epoch {e} - imgs @ {config["img_dir"]} - model @ {config["model_dir"]}')
 
+    ckpt_writer.close()
+
 
 def test(model, test_loader, writer, config):
     # plot a few samples with recon
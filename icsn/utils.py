@@ -65,6 +65,154 @@ def makedirs(path):
         os.makedirs(path)
 
 
+def atomic_save(obj, path):
+    """
+    Save obj with torch.save to a temporary file that is then renamed to path, so that path is never partly written.
+    Same as disent.util.atomic_save.
+    """
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    torch.save(obj, path + '.tmp')
+    os.rename(path + '.tmp', path)
+
+
+def snapshot_to_cpu(obj):
+    """
+    Same as disent.util.snapshot_to_cpu.
+    Copy all tensors in a nested state (dicts, lists, tuples and nn.Modules)
+    to the cpu, so that the state can be saved while training continues to
+    update the original tensors in place.
+
+    Tensors sharing a storage, eg. the parameters of a module and the
+    entries of its state_dict, still share a storage in the snapshot,
+    so that torch.save does not write them twice.
+    """
+    import copy
+    import itertools
+    import torch
+
+    storages = {}
+    module_memo = {}
+
+    def _snapshot_tensor(tensor):
+        tensor = tensor.detach()
+        storage = tensor.untyped_storage()
+        key = (storage.data_ptr(), tensor.device)
+        if key not in storages:
+            storages[key] = storage.clone() if tensor.device.type == 'cpu' else storage.cpu()
+        return torch.empty(0, dtype=tensor.dtype).set_(storages[key], tensor.storage_offset(), tensor.size(), tensor.stride())
+
+    def _snapshot(obj):
+        if isinstance(obj, torch.Tensor):
+            return _snapshot_tensor(obj)
+        elif isinstance(obj, torch.nn.Module):
+            # copy the module without its tensors, which are replaced by their snapshots through the memo
+            for tensor in itertools.chain(obj.parameters(), obj.buffers()):
+                if id(tensor) not in module_memo:
+                    snapshot = _snapshot_tensor(tensor)
+                    if isinstance(tensor, torch.nn.Parameter):
+                        snapshot = torch.nn.Parameter(snapshot, requires_grad=tensor.requires_grad)
+                    module_memo[id(tensor)] = snapshot
+            return copy.deepcopy(obj, module_memo)
+        elif isinstance(obj, dict):
+            snapshot = type(obj)((k, _snapshot(v)) for k, v in obj.items())
+            # state_dicts store the module versions as an attribute
+            if hasattr(obj, '_metadata'):
+                snapshot._metadata = copy.deepcopy(obj._metadata)
+            return snapshot
+        elif isinstance(obj, (list, tuple)):
+            return type(obj)(_snapshot(v) for v in obj)
+        else:
+            return copy.deepcopy(obj)
+
+    return _snapshot(obj)
+
+
+class AsyncCheckpointWriter(object):
+    """
+    Same as disent.util.AsyncCheckpointWriter.
+    Save checkpoints from a background thread so that training does not
+    block on disk I/O. Calling save() only takes a cpu snapshot of the
+    state, which is then written with atomic_save by a worker thread.
+
+    If max_to_keep is given, only the most recent max_to_keep checkpoints
+    written by this writer are kept, older ones are deleted after each write.
+    At most max_pending snapshots wait to be written at a time, further calls
+    to save() block until the worker has caught up.
+    Errors of the worker thread are raised on the next call to save() or close(),
+    errors that are never collected are logged at exit.
+    """
+
+    def __init__(self, max_to_keep=None, max_pending=2):
+        import atexit
+        import queue
+        import threading
+
+        assert (max_to_keep is None) or (max_to_keep > 0), f'max_to_keep must be None or positive, got: {max_to_keep}'
+        assert max_pending > 0, f'max_pending must be positive, got: {max_pending}'
+        self.max_to_keep = max_to_keep
+        self._saved_paths = []
+        self._error = None
+        # bounded, so snapshots can not pile up in memory when the disk is slower than training
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._worker, name='AsyncCheckpointWriter', daemon=True)
+        self._thread.start()
+        # pending checkpoints are still written if training exits without calling close()
+        atexit.register(self._close_at_exit)
+
+    def _worker(self):
+        import os
+
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                state, path = item
+                atomic_save(state, path)
+                # retention policy
+                self._saved_paths.append(path)
+                if self.max_to_keep is not None:
+                    while len(self._saved_paths) > self.max_to_keep:
+                        old_path = self._saved_paths.pop(0)
+                        if os.path.exists(old_path) and (old_path != path):
+                            os.remove(old_path)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('Writing a checkpoint failed') from error
+
+    def save(self, state, path):
+        self._raise_error()
+        assert self._thread.is_alive(), 'AsyncCheckpointWriter has already been closed'
+        self._queue.put((snapshot_to_cpu(state), path))
+
+    def wait(self):
+        """Block until all pending checkpoints are written."""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def _close_at_exit(self):
+        import logging
+
+        # raising during interpreter shutdown only produces a confusing traceback
+        try:
+            self.close()
+        except RuntimeError as e:
+            logging.getLogger(__name__).error(str(e), exc_info=e.__cause__)
+
+
 def get_cum_group_ids(self):
     group_ids = list(np.cumsum(self.n_proto_vecs))
     group_ids.insert(0, 0)
@@ -80,6 +228,26 @@ def freeze_enc(model):
             p.requires_grad = False
 
 
+def check_finite(loss, model, step):
+    """
+    Lightweight NaN/Inf watchdog for the training loop, to be called after loss.backward(). The loss and the norms of
+    all parameter gradients are reduced on the device and checked with a single host sync, if anything is not finite
+    a FloatingPointError naming the affected parameters is raised. Unlike torch.autograd.set_detect_anomaly this does
+    not record the forward pass, rerun with --debug-anomaly to find the op that produced the non-finite values.
+    :param loss: scalar loss tensor of the current step
+    :param model: model whose parameter gradients are checked
+    :param step: current step, only used for the error message
+    """
+    grad_norms = [p.grad.detach().norm() for p in model.parameters() if p.grad is not None]
+    if torch.isfinite(torch.stack([loss.detach().float()] + grad_norms).sum()).item():
+        return
+
+    bad_params = [name for name, p in model.named_parameters()
+                  if p.grad is not None and not torch.isfinite(p.grad).all()]
+    raise FloatingPointError(f'non-finite values at step {step}: loss {loss.item()}, gradients of {bad_params}, '
+                             f'rerun with --debug-anomaly to locate the op')
+
+
 def plot_prototypes(model, writer, config, step=0):
     """
     Visualize all mixtures of prototypes.